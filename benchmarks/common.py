@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+from datetime import datetime
+import os, time, statistics, subprocess, platform, json
+
+def make_app(database_uri=None, **config):
+    """App pointed at BENCH_DATABASE_URI, an in-memory SQLite database by default."""
+    from website import create_app
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': database_uri or os.getenv('BENCH_DATABASE_URI', 'sqlite://'),
+        'SECRET_KEY': os.getenv('SECRET_KEY') or 'bench',
+        **config,
+    })
+
+@contextmanager
+def count_queries(engine):
+    """Collect every SQL statement the engine runs inside the block."""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+def timed(fn, repeat):
+    """Run `fn` `repeat` times and return latency percentiles in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+def percentiles(samples):
+    """p50/p99/max in milliseconds of latencies given in seconds."""
+    samples = sorted(samples)
+    if not samples:
+        return {'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+    return {
+        'p50_ms': 1000 * statistics.median(samples),
+        'p99_ms': 1000 * samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'max_ms': 1000 * samples[-1],
+    }
+
+def add_json_argument(parser):
+    parser.add_argument('--json', metavar='PATH', help='also write the results to PATH, see benchmarks.compare')
+
+def write_json(path, benchmark, args, results):
+    """Write results with enough context (commit, machine, arguments) to diff two runs."""
+    if not path:
+        return
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    document = {
+        'benchmark': benchmark,
+        'revision': revision,
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key != 'json'},
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, default=str)
+    print(f'results written to {path}')
@@ -0,0 +1,69 @@
+"""Diff two benchmark result files written with --json.
+
+Prints every metric that changed and exits non-zero when one got worse by
+more than --threshold percent, e.g. between the main branch and a change:
+
+    python -m benchmarks.compare base.json head.json [--threshold 10]
+"""
+import argparse, json, sys
+
+# metric name suffix -> True when higher is better
+DIRECTIONS = {
+    '_ms': False,
+    '_seconds': False,
+    'statements': False,
+    'errors': False,
+    'per_second': True,
+}
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f'{prefix}.{key}' if prefix else str(key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+def direction(metric):
+    for suffix, higher_is_better in DIRECTIONS.items():
+        if metric.endswith(suffix):
+            return higher_is_better
+    return None
+
+def compare(base, head, threshold):
+    base_metrics, head_metrics = dict(flatten(base['results'])), dict(flatten(head['results']))
+    regressions = []
+    for metric in sorted(base_metrics.keys() & head_metrics.keys()):
+        higher_is_better = direction(metric.rsplit('.', 1)[-1])
+        before, after = base_metrics[metric], head_metrics[metric]
+        if higher_is_better is None or before == after:
+            continue
+        change = 100 * (after - before) / before if before else float('inf')
+        worse = change < -threshold if higher_is_better else change > threshold
+        # statement counts and errors are exact, any increase counts
+        if metric.endswith(('statements', 'errors')):
+            worse = after > before
+        print(f'{"WORSE" if worse else "     "} {metric:50} {before:12.3f} -> {after:12.3f} ({change:+.1f}%)')
+        if worse:
+            regressions.append(metric)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=10, help='percent a timing may get worse before it counts')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+    if base['benchmark'] != head['benchmark']:
+        sys.exit(f'cannot compare {base["benchmark"]} with {head["benchmark"]}')
+    print(f'{base["benchmark"]}: {base["revision"]} ({base["timestamp"]}) -> {head["revision"]} ({head["timestamp"]})')
+    regressions = compare(base, head, args.threshold)
+    print(f'{len(regressions)} regression(s)')
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
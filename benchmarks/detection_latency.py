@@ -0,0 +1,111 @@
+"""Detection latency and throughput.
+
+Runs the YOLOS model the way the detection workers do (reduced decode, then
+one forward pass per batch) on sample images, and reports per-phase latency
+for single images and images/second for each batch size.
+
+The sample images are generated (a deterministic scene per size, as JPEG
+and PNG) so nothing large is checked in; pass --images to use a folder of
+real photos instead. Needs torch and transformers.
+
+    python -m benchmarks.detection_latency [--variant quantized] [--batch-sizes 1,2,4,8] [--json detection.json]
+"""
+from .common import percentiles, add_json_argument, write_json
+from website.detection import detect_batch, model_input_edge
+from website.model_registry import model_registry
+from website.uploads import open_reduced
+from PIL import Image, ImageDraw
+import argparse, io, os, random, sys, time
+
+SAMPLE_SIZES = {
+    'phone_12mp.jpg': ((4032, 3024), 'JPEG'),
+    'web_1600.jpg': ((1600, 1200), 'JPEG'),
+    'square_1080.png': ((1080, 1080), 'PNG'),
+}
+
+def sample_images(folder=None):
+    """`{name: encoded bytes}` from `folder`, or the generated samples."""
+    if folder:
+        return {name: open(os.path.join(folder, name), 'rb').read() for name in sorted(os.listdir(folder))
+                if name.lower().endswith(('.jpg', '.jpeg', '.png'))}
+
+    images = {}
+    for name, (size, fmt) in SAMPLE_SIZES.items():
+        rng = random.Random(name)
+        image = Image.new('RGB', size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(40):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            w, h = rng.randrange(size[0] // 4), rng.randrange(size[1] // 4)
+            draw.rectangle((x, y, x + w, y + h), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        buffer = io.BytesIO()
+        image.save(buffer, fmt, quality=90)
+        images[name] = buffer.getvalue()
+    return images
+
+def single_image(images, edge, repeat):
+    results = {}
+    for name, data in images.items():
+        phases = {}
+        for _ in range(repeat):
+            timings = {}
+            started = time.perf_counter()
+            image = open_reduced(data, edge)
+            timings['decode'] = time.perf_counter() - started
+            detect_batch([image], timings)
+            timings['total'] = time.perf_counter() - started
+            for phase, seconds in timings.items():
+                phases.setdefault(phase, []).append(seconds)
+        results[name] = {phase: percentiles(samples) for phase, samples in phases.items()}
+        print(f'{name:16} ' + '  '.join(f'{phase} p50 {stats["p50_ms"]:.1f}ms' for phase, stats in results[name].items()))
+    return results
+
+def throughput(images, edge, batch_sizes, batches):
+    decoded = [open_reduced(data, edge) for data in images.values()]
+    results = {}
+    for batch_size in batch_sizes:
+        batch = [decoded[i % len(decoded)] for i in range(batch_size)]
+        detect_batch(batch)  # warm up this shape
+        started = time.perf_counter()
+        for _ in range(batches):
+            detect_batch(batch)
+        elapsed = time.perf_counter() - started
+        results[batch_size] = {'images_per_second': batch_size * batches / elapsed,
+                               'batch_ms': 1000 * elapsed / batches}
+        print(f'batch {batch_size:2}: {results[batch_size]["images_per_second"]:6.2f} images/s, '
+              f'{results[batch_size]["batch_ms"]:.0f}ms per batch')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', help='folder of JPEG/PNG images to use instead of the generated samples')
+    parser.add_argument('--model', default=os.getenv('DETECTION_MODEL', 'hustvl/yolos-tiny'))
+    parser.add_argument('--variant', default='default', choices=('default', 'quantized'))
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--batch-sizes', default='1,2,4,8')
+    parser.add_argument('--batches', type=int, default=5)
+    add_json_argument(parser)
+    args = parser.parse_args()
+
+    try:
+        import torch, transformers
+    except ImportError:
+        sys.exit('benchmarks.detection_latency needs torch and transformers installed')
+
+    model_registry.model_name, model_registry.variant = args.model, args.variant
+    started = time.perf_counter()
+    _, image_processor = model_registry.get()
+    load_seconds = time.perf_counter() - started
+    edge = model_input_edge(image_processor)
+    print(f'{model_registry.key} loaded in {load_seconds:.1f}s, input edge {edge}px, {torch.get_num_threads()} threads')
+
+    images = sample_images(args.images)
+    results = {
+        'model_load_seconds': load_seconds,
+        'single_image': single_image(images, edge, args.repeat),
+        'throughput': throughput(images, edge, [int(size) for size in args.batch_sizes.split(',')], args.batches),
+    }
+    write_json(args.json, 'detection_latency', args, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Regression benchmark for the feed sort options.
+
+Seeds tens of thousands of posts and votes, then checks that every sort loads
+a page in a single query, returns each post once, and stays under a latency
+budget for both the first page and a page deep into the feed.
+
+    python -m benchmarks.feed_sorts --posts 20000 --votes 50000 --budget-ms 50
+"""
+from .common import make_app, count_queries, timed, add_json_argument, write_json
+from .seed import seed
+from website.models import db
+from website.feed import SORTS, feed_page
+import argparse, sys
+
+def run(posts, votes, budget_ms, repeat, deep_pages):
+    app = make_app()
+    failures, results = [], {}
+    with app.app_context():
+        seed(posts=posts, votes=votes)
+
+        for sort_option in SORTS:
+            # walk into the feed to get a cursor for a deep page
+            cursor, seen = None, set()
+            for _ in range(deep_pages):
+                page, cursor = feed_page(sort_option, cursor)
+                seen.update(post.id for post in page)
+            if len(seen) != deep_pages * len(page):
+                failures.append(f'{sort_option}: a post was returned more than once')
+
+            for label, page_cursor in (('first', None), ('deep', cursor)):
+                with count_queries(db.engine) as statements:
+                    feed_page(sort_option, page_cursor)
+                latency = timed(lambda: feed_page(sort_option, page_cursor), repeat)
+                results[f'{sort_option}.{label}'] = {'statements': len(statements), **latency}
+                print(f'{sort_option:12} {label:5} page: {len(statements)} query, '
+                      f'p50 {latency["p50_ms"]:.2f}ms, p99 {latency["p99_ms"]:.2f}ms')
+                if len(statements) != 1:
+                    failures.append(f'{sort_option} {label} page issued {len(statements)} queries')
+                if latency['p99_ms'] > budget_ms:
+                    failures.append(f'{sort_option} {label} page p99 {latency["p99_ms"]:.2f}ms > {budget_ms}ms')
+    return failures, results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--votes', type=int, default=50000)
+    parser.add_argument('--budget-ms', type=float, default=50)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--deep-pages', type=int, default=20)
+    add_json_argument(parser)
+    args = parser.parse_args()
+
+    failures, results = run(args.posts, args.votes, args.budget_ms, args.repeat, args.deep_pages)
+    write_json(args.json, 'feed_sorts', args, {'pages': results, 'failures': failures})
+    for failure in failures:
+        print('FAIL', failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
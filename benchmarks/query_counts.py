@@ -0,0 +1,73 @@
+"""Query-count guard for the feed, profile and post pages.
+
+Renders every page against a small and a large dataset and fails if a page
+issues more statements than its budget, or more on the large dataset than on
+the small one (an N+1 creeping back in).
+
+    python -m benchmarks.query_counts [--json query_counts.json]
+"""
+from .common import make_app, count_queries, add_json_argument, write_json
+from .seed import seed
+from website.models import db, User, Post, Comment
+import argparse, sys
+
+# statements per request, including the logged-in user lookup
+BUDGETS = {
+    'feed': 2,
+    'feed_page': 2,
+    'profile': 3,
+    'post': 3,
+}
+
+def page_counts(users, posts, comments):
+    app = make_app()
+    client = app.test_client()
+    with app.app_context():
+        seed(users=users, posts=posts, votes=posts, comments=comments)
+        busiest_post = db.session.query(Comment.post_id).group_by(Comment.post_id)\
+            .order_by(db.func.count().desc()).limit(1).scalar()
+        busiest_user = db.session.query(User.handle).join(Post).group_by(User.handle)\
+            .order_by(db.func.count().desc()).limit(1).scalar()
+
+    client.post('/signup', data={'emailInput': 'bench@example.com', 'nameInput': 'Bench Runner', 'handleInput': 'bench',
+                                 'passwordInput': 'benchmark', 'confirmPasswordInput': 'benchmark'})
+    with app.app_context():
+        engine = db.engine
+
+    # requests run outside any app context of ours so each gets a fresh session
+    counts = {}
+    for name, url in (('feed', '/feed?sort=most_karma'), ('profile', f'/profile/{busiest_user}'), ('post', f'/post/{busiest_post}')):
+        with count_queries(engine) as statements:
+            response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+        counts[name] = len(statements)
+
+    cursor = client.get('/feed?sort=newest').data.decode()
+    cursor = cursor.split('var nextCursor = ', 1)[1].split(';', 1)[0].strip('"')
+    with count_queries(engine) as statements:
+        assert client.get(f'/feed/page?sort=newest&cursor={cursor}').status_code == 200
+    counts['feed_page'] = len(statements)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_json_argument(parser)
+    args = parser.parse_args()
+
+    small = page_counts(users=5, posts=50, comments=20)
+    large = page_counts(users=200, posts=5000, comments=5000)
+    failures = []
+    for name, budget in BUDGETS.items():
+        print(f'{name:10} small: {small[name]} statements, large: {large[name]} statements (budget {budget})')
+        if large[name] > budget:
+            failures.append(f'{name} issued {large[name]} statements, budget is {budget}')
+        if large[name] > small[name]:
+            failures.append(f'{name} issues more statements as the data grows ({small[name]} -> {large[name]})')
+    for failure in failures:
+        print('FAIL', failure)
+    write_json(args.json, 'query_counts', args, {name: {'small_statements': small[name], 'large_statements': large[name]}
+                                                 for name in BUDGETS})
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
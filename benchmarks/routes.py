@@ -0,0 +1,80 @@
+"""Per-route microbenchmarks.
+
+Calls every read route, and the vote and comment routes, through the test
+client against a seeded database and reports latency percentiles and SQL
+statements per request. The feed cache is off unless --feed-cache is given,
+so the numbers are those of the handlers themselves.
+
+    python -m benchmarks.routes [--posts 20000] [--repeat 200] [--json routes.json]
+"""
+from .common import make_app, count_queries, percentiles, add_json_argument, write_json
+from .seed import seed
+from website.models import db, User, Post, Comment
+import argparse, time
+
+def routes(post_id, comment_id, handle):
+    """(name, method, url, form data) for every benchmarked route."""
+    return [
+        ('landing', 'GET', '/', None),
+        ('feed_newest', 'GET', '/feed?sort=newest', None),
+        ('feed_most_karma', 'GET', '/feed?sort=most_karma', None),
+        ('feed_page', 'GET', None, None),  # url filled in once the first page's cursor is known
+        ('profile', 'GET', f'/profile/{handle}', None),
+        ('post', 'GET', f'/post/{post_id}', None),
+        ('upvote_post', 'GET', f'/karma/upvote-karma/_/{post_id}', None),
+        ('upvote_comment', 'GET', f'/karma/upvote-karma/_/{comment_id}', None),
+        ('new_comment', 'POST', f'/post/{post_id}/new-comment', {'comment_text': 'benchmark comment'}),
+    ]
+
+def run(args):
+    app = make_app(FEED_CACHE_SIZE=2048 if args.feed_cache else 0, FEED_CACHE_LOCAL=True)
+    with app.app_context():
+        seed(users=args.users, posts=args.posts, votes=args.votes, comments=args.comments, comment_votes=args.comments)
+        engine = db.engine
+        # the busiest post and author, so the pages are as heavy as the dataset allows
+        post_id = db.session.query(Comment.post_id).group_by(Comment.post_id)\
+            .order_by(db.func.count().desc()).limit(1).scalar()
+        comment_id = db.session.query(Comment.id).filter_by(post_id=post_id).limit(1).scalar()
+        handle = db.session.query(User.handle).join(Post).group_by(User.handle)\
+            .order_by(db.func.count().desc()).limit(1).scalar()
+
+    client = app.test_client()
+    client.post('/signup', data={'emailInput': 'bench@example.com', 'nameInput': 'Bench Runner', 'handleInput': 'bench',
+                                 'passwordInput': 'benchmark', 'confirmPasswordInput': 'benchmark'})
+    cursor = client.get('/feed?sort=newest').data.decode().split('var nextCursor = ', 1)[1].split(';', 1)[0].strip('"')
+
+    results = {}
+    for name, method, url, data in routes(post_id, comment_id, handle):
+        url = url or f'/feed/page?sort=newest&cursor={cursor}'
+        request = lambda: client.open(url, method=method, data=data)
+        for _ in range(args.warmup):
+            request()
+        with count_queries(engine) as statements:
+            response = request()
+        assert response.status_code in (200, 302), (name, response.status_code)
+
+        samples = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            request()
+            samples.append(time.perf_counter() - started)
+        results[name] = {'statements': len(statements), **percentiles(samples)}
+        print(f'{name:16} {len(statements):3} statements  p50 {results[name]["p50_ms"]:7.2f}ms  '
+              f'p99 {results[name]["p99_ms"]:7.2f}ms')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--votes', type=int, default=50000)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--feed-cache', action='store_true', help='measure the feed with its cache enabled')
+    add_json_argument(parser)
+    args = parser.parse_args()
+    write_json(args.json, 'routes', args, run(args))
+
+if __name__ == '__main__':
+    main()
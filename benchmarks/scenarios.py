@@ -0,0 +1,181 @@
+"""Locust-style scenario runner.
+
+Simulated users sign up, then repeatedly pick a weighted task (browse the
+feed, scroll it, open a post or profile, vote, comment) with a think time
+in between, the mix a real session produces. Runs in process against a
+seeded database, or against a running server with --url.
+
+    python -m benchmarks.scenarios [--users 20] [--duration 30] [--url http://localhost:8000] [--json scenarios.json]
+"""
+from .common import make_app, percentiles, add_json_argument, write_json
+from .seed import seed
+from http.cookiejar import CookieJar
+from urllib.parse import urlencode
+import argparse, random, re, threading, time, urllib.error, urllib.request
+
+POST_LINK = re.compile(r'/post/([0-9a-f-]{36})')
+PROFILE_LINK = re.compile(r'/profile/([\w.-]+)"')
+NEXT_CURSOR = re.compile(r'var nextCursor = "([^"]+)"')
+
+TASKS = {}
+
+def task(weight):
+    def register(fn):
+        TASKS[fn.__name__] = (weight, fn)
+        return fn
+    return register
+
+
+class AppClient:
+    """Requests through the Flask test client, one per simulated user."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpClient:
+    """Requests to a running server, keeping cookies like a browser."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def request(self, method, path, data=None):
+        body = urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method), timeout=30) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, ''
+
+
+class VirtualUser:
+    def __init__(self, client, number, rng, record):
+        self.client = client
+        self.number = number
+        self.rng = rng
+        self.record = record
+        self.post_ids = []
+        self.handles = []
+        self.cursor = None
+
+    def call(self, name, method, path, data=None):
+        started = time.perf_counter()
+        try:
+            status, text = self.client.request(method, path, data)
+        except OSError:
+            status, text = None, ''
+        self.record(name, time.perf_counter() - started, status is not None and status < 400)
+        # remember what the page links to, like a user clicking around would
+        self.post_ids = (POST_LINK.findall(text) + self.post_ids)[:100]
+        self.handles = (PROFILE_LINK.findall(text) + self.handles)[:50]
+        return text
+
+    def sign_up(self):
+        handle = f'load{self.number}_{self.rng.randrange(10**9)}'
+        self.call('sign_up', 'POST', '/signup', {
+            'emailInput': f'{handle}@example.com', 'nameInput': f'Load User {self.number}', 'handleInput': handle,
+            'passwordInput': 'loadtest1', 'confirmPasswordInput': 'loadtest1',
+        })
+
+    @task(10)
+    def browse_feed(self):
+        sort = self.rng.choice(('newest', 'oldest', 'most_karma', 'least_karma'))
+        match = NEXT_CURSOR.search(self.call('browse_feed', 'GET', f'/feed?sort={sort}'))
+        self.cursor = (sort, match.group(1)) if match else None
+
+    @task(5)
+    def scroll_feed(self):
+        if self.cursor is None:
+            return self.browse_feed()
+        sort, cursor = self.cursor
+        self.call('scroll_feed', 'GET', f'/feed/page?{urlencode({"sort": sort, "cursor": cursor})}')
+
+    @task(6)
+    def view_post(self):
+        if self.post_ids:
+            self.call('view_post', 'GET', f'/post/{self.rng.choice(self.post_ids)}')
+
+    @task(3)
+    def view_profile(self):
+        if self.handles:
+            self.call('view_profile', 'GET', f'/profile/{self.rng.choice(self.handles)}')
+
+    @task(2)
+    def vote(self):
+        if self.post_ids:
+            direction = self.rng.choice(('upvote', 'downvote'))
+            self.call('vote', 'GET', f'/karma/{direction}-karma/_/{self.rng.choice(self.post_ids)}')
+
+    @task(1)
+    def comment(self):
+        if self.post_ids:
+            self.call('comment', 'POST', f'/post/{self.rng.choice(self.post_ids)}/new-comment', {'comment_text': 'load test'})
+
+    def run(self, deadline, think_time):
+        self.sign_up()
+        names = list(TASKS)
+        weights = [TASKS[name][0] for name in names]
+        while time.monotonic() < deadline:
+            TASKS[self.rng.choices(names, weights)[0]][1](self)
+            time.sleep(self.rng.uniform(*think_time))
+
+
+def run(args):
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        app = make_app()
+        with app.app_context():
+            seed(users=200, posts=args.posts, votes=args.posts * 2, comments=args.posts)
+        make_client = lambda: AppClient(app)
+
+    lock = threading.Lock()
+    samples = {}
+    def record(name, seconds, ok):
+        with lock:
+            latencies, errors = samples.setdefault(name, ([], [0]))
+            latencies.append(seconds)
+            errors[0] += not ok
+
+    deadline = time.monotonic() + args.duration
+    think_time = (args.think_ms[0] / 1000, args.think_ms[1] / 1000)
+    users = [VirtualUser(make_client(), i, random.Random(args.seed + i), record) for i in range(args.users)]
+    threads = [threading.Thread(target=user.run, args=(deadline, think_time)) for user in users]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+        time.sleep(args.ramp_up / max(len(threads), 1))
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    results = {}
+    for name, (latencies, errors) in sorted(samples.items()):
+        results[name] = {'requests': len(latencies), 'errors': errors[0],
+                         'requests_per_second': len(latencies) / elapsed, **percentiles(latencies)}
+        print(f'{name:14} {len(latencies):6} requests  {errors[0]:4} errors  {results[name]["requests_per_second"]:7.1f} req/s  '
+              f'p50 {results[name]["p50_ms"]:7.1f}ms  p99 {results[name]["p99_ms"]:7.1f}ms')
+    total = sum(result['requests'] for result in results.values())
+    print(f'{"total":14} {total:6} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='base url of a running server; seeds and runs in process when omitted')
+    parser.add_argument('--users', type=int, default=20, help='simulated users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds over which the users start')
+    parser.add_argument('--think-ms', type=float, nargs=2, default=(100, 500), metavar=('MIN', 'MAX'))
+    parser.add_argument('--posts', type=int, default=5000, help='posts to seed when running in process')
+    parser.add_argument('--seed', type=int, default=0)
+    add_json_argument(parser)
+    args = parser.parse_args()
+    write_json(args.json, 'scenarios', args, run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Search latency at scale.
+
+Seeds a million posts and a million comments (titles and comments drawn
+from a Zipf-weighted vocabulary) and times full-text queries on common,
+rare and missing words, later pages, and handle typeahead. Meant for
+Postgres, where the GIN and trigram indexes are used; against SQLite it
+measures the LIKE fallback.
+
+    python -m benchmarks.search --database-uri postgresql://localhost/tables_bench [--posts 1000000] [--explain] [--json search.json]
+"""
+from .common import make_app, count_queries, timed, add_json_argument, write_json
+from .seed import seed
+from website.models import db, Post
+from website.search import search, SEARCHES
+import argparse, time
+
+QUERIES = [
+    ('posts_common_word', 'posts', 'chair', 1),
+    ('posts_rare_word', 'posts', 'porch', 1),
+    ('posts_two_words', 'posts', 'wooden table', 1),
+    ('posts_no_match', 'posts', 'spaceship', 1),
+    ('posts_page_5', 'posts', 'chair', 5),
+    ('comments_common_word', 'comments', 'table', 1),
+    ('comments_phrase', 'comments', '"rocking chair"', 1),
+    ('users_prefix', 'users', 'user12', 1),
+    ('users_fuzzy', 'users', 'usr123', 1),
+]
+
+def run(args):
+    app = make_app(args.database_uri)
+    with app.app_context():
+        if db.session.query(Post.id).limit(1).scalar() is None:
+            started = time.perf_counter()
+            seed(users=args.users, posts=args.posts, votes=0, comments=args.comments)
+            print(f'seeded {args.posts} posts and {args.comments} comments in {time.perf_counter() - started:.1f}s')
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text('ANALYZE'))
+
+        results = {}
+        for name, kind, q, page in QUERIES:
+            with count_queries(db.engine) as statements:
+                found, _ = search(kind, q, page)
+            stats = timed(lambda: search(kind, q, page), args.repeat)
+            results[name] = {'results': len(found), 'statements': len(statements), **stats}
+            print(f'{name:22} {len(found):3} results  p50 {stats["p50_ms"]:8.2f}ms  p99 {stats["p99_ms"]:8.2f}ms')
+            if args.explain:
+                query = SEARCHES[kind](q).limit(21)
+                explain = 'EXPLAIN' if db.engine.dialect.name == 'postgresql' else 'EXPLAIN QUERY PLAN'
+                sql = str(query.compile(db.engine, compile_kwargs={'literal_binds': True}))
+                print('\n'.join(f'    {row[-1]}' for row in db.session.execute(db.text(f'{explain} {sql}'))))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-uri', help='defaults to BENCH_DATABASE_URI; seeded unless it already has posts')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--comments', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--explain', action='store_true', help='print the query plan of each search')
+    add_json_argument(parser)
+    args = parser.parse_args()
+    write_json(args.json, 'search', args, run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Reproducible synthetic data for the benchmarks.
+
+Run on its own to fill a local Postgres (or SQLite) database at any scale:
+
+    python -m benchmarks.seed --database-uri postgresql://localhost/tables_bench --posts 200000 --votes 1000000
+"""
+from .common import make_app
+from website.models import db, User, Post, Comment, Karma
+from datetime import datetime, timedelta
+import argparse, random, time, uuid
+
+CHUNK = 10000
+
+# titles and comments are drawn from this with Zipf-like weights, so searches
+# hit a realistic mix of common and rare words
+WORDS = (
+    'chair table wooden office vintage comfy kitchen garden modern old new my first last best worst favourite '
+    'found made restored painted broken fixed rocking folding dining desk bench stool sofa armchair lounge '
+    'oak pine walnut metal plastic leather velvet red blue green black white grey cosy tiny huge antique '
+    'cheap free thrift market grandma friend office studio cafe library school park beach balcony porch '
+    'sunday morning evening weekend project build diy design idea look view light shadow corner window'
+).split()
+WEIGHTS = [1 / rank for rank in range(1, len(WORDS) + 1)]
+
+def phrase(rng, words):
+    return ' '.join(rng.choices(WORDS, WEIGHTS, k=words))
+
+def insert(model, rows):
+    # chunked so a million-row seed doesn't build one enormous statement
+    for start in range(0, len(rows), CHUNK):
+        db.session.execute(db.insert(model), rows[start:start + CHUNK])
+
+def seed(users=200, posts=20000, votes=50000, comments=0, comment_votes=0, seed=0):
+    """Bulk-insert a reproducible synthetic dataset and return its row ids."""
+    rng = random.Random(seed)
+    # separate stream for the text, so the ids and timestamps stay the same as before it existed
+    text_rng = random.Random(f'text-{seed}')
+    start = datetime(2023, 1, 1)
+
+    user_ids = [uuid.UUID(int=rng.getrandbits(128)) for _ in range(users)]
+    insert(User, [{
+        'id': user_id,
+        'handle': f'user{i}',
+        'name': f'Bench User {i}',
+        'email': f'user{i}@example.com',
+        'password': 'not-a-real-hash',
+        'strikes': 0,
+        'pfp_url': '/static/user.svg',
+    } for i, user_id in enumerate(user_ids)])
+
+    post_rows = [{
+        'id': uuid.UUID(int=rng.getrandbits(128)),
+        'image_url': '/static/logo.svg',
+        'post_title': phrase(text_rng, text_rng.randint(2, 6)),
+        'timestamp': start + timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+        'contains_chair': True,
+        'status': 'published',
+        'score': 0,
+        'user_id': rng.choice(user_ids),
+    } for _ in range(posts)]
+
+    scores = {}
+    vote_rows = []
+    seen = set()
+    while len(vote_rows) < min(votes, users * posts):
+        user_id, post = rng.choice(user_ids), rng.choice(post_rows)
+        if (user_id, post['id']) in seen:
+            continue
+        seen.add((user_id, post['id']))
+        value = rng.choice((1, 1, 1, -1))
+        scores[post['id']] = scores.get(post['id'], 0) + value
+        vote_rows.append({'id': uuid.UUID(int=rng.getrandbits(128)), 'karma': value, 'user_id': user_id, 'post_id': post['id']})
+    for post in post_rows:
+        post['score'] = scores.get(post['id'], 0)
+
+    comment_rows = [{
+        'id': uuid.UUID(int=rng.getrandbits(128)),
+        'text': phrase(text_rng, text_rng.randint(3, 15)),
+        'timestamp': start + timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+        'score': 0,
+        'user_id': rng.choice(user_ids),
+        'post_id': rng.choice(post_rows)['id'],
+    } for _ in range(comments)]
+
+    comment_scores = {}
+    seen = set()
+    while comment_rows and len(seen) < min(comment_votes, users * len(comment_rows)):
+        user_id, comment = rng.choice(user_ids), rng.choice(comment_rows)
+        if (user_id, comment['id']) in seen:
+            continue
+        seen.add((user_id, comment['id']))
+        value = rng.choice((1, 1, 1, -1))
+        comment_scores[comment['id']] = comment_scores.get(comment['id'], 0) + value
+        vote_rows.append({'id': uuid.UUID(int=rng.getrandbits(128)), 'karma': value, 'user_id': user_id, 'comment_id': comment['id']})
+    for comment in comment_rows:
+        comment['score'] = comment_scores.get(comment['id'], 0)
+
+    insert(Post, post_rows)
+    insert(Comment, comment_rows)
+    insert(Karma, vote_rows)
+    db.session.commit()
+    return user_ids, [post['id'] for post in post_rows]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-uri', help='defaults to BENCH_DATABASE_URI; the tables are created if missing')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--votes', type=int, default=50000)
+    parser.add_argument('--comments', type=int, default=20000)
+    parser.add_argument('--comment-votes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = make_app(args.database_uri)
+    started = time.perf_counter()
+    with app.app_context():
+        seed(args.users, args.posts, args.votes, args.comments, args.comment_votes, args.seed)
+    print(f'seeded {args.users} users, {args.posts} posts, {args.comments} comments and '
+          f'{args.votes + args.comment_votes} votes in {time.perf_counter() - started:.1f}s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Load-test gunicorn's sync workers against its gthread workers.
+
+Both get the same number of worker processes; gthread runs --threads
+requests at a time in each. They serve a seeded SQLite database. Every SQL statement sleeps --db-latency-ms first, standing
+in for the round trip to Postgres, so the test is I/O-bound the way
+production is. Reports requests/second and latency percentiles per mode.
+
+    python -m benchmarks.serving [--workers 4] [--threads 8] [--concurrency 64] [--duration 15] [--json serving.json]
+
+Needs gunicorn installed.
+"""
+from .common import make_app, percentiles, add_json_argument, write_json
+from .seed import seed
+from sqlalchemy import event
+from http.client import HTTPConnection
+import argparse, itertools, multiprocessing as mp, os, socket, subprocess, sys, tempfile, threading, time
+
+def _server_app():
+    app = make_app(os.environ['BENCH_DATABASE_URI'], FEED_CACHE_SIZE=0, INSTRUMENTATION=False)
+    latency = float(os.getenv('BENCH_DB_LATENCY_MS', 0)) / 1000
+    if latency:
+        from website.models import db
+        with app.app_context():
+            @event.listens_for(db.engine, 'before_cursor_execute')
+            def network_round_trip(*args):
+                time.sleep(latency)
+    return app
+
+def wsgi_app():
+    return _server_app()
+
+COMMANDS = {
+    'sync': lambda port, workers, threads: [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                                            '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'benchmarks.serving:wsgi_app()'],
+    'gthread': lambda port, workers, threads: [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                                               '--worker-class', 'gthread', '--threads', str(threads),
+                                               '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'benchmarks.serving:wsgi_app()'],
+}
+
+def prepare(database_uri):
+    """Seed the database and return a logged-in cookie header and the urls to request."""
+    app = make_app(database_uri)
+    with app.app_context():
+        user_ids, post_ids = seed(users=200, posts=5000, votes=20000, comments=5000)
+    client = app.test_client()
+    client.post('/signup', data={'emailInput': 'bench@example.com', 'nameInput': 'Bench Runner', 'handleInput': 'bench',
+                                 'passwordInput': 'benchmark', 'confirmPasswordInput': 'benchmark'})
+    cookie = '; '.join(f'{c.name}={c.value}' for c in client.cookie_jar)
+    urls = ['/feed?sort=newest', '/feed?sort=most_karma', '/profile/user1', *(f'/post/{post_id}' for post_id in post_ids[:50])]
+    return cookie, urls
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _wait_ready(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not come up')
+
+def _client(port, cookie, urls, threads, duration, results):
+    latencies, errors = [], [0]
+    deadline = time.monotonic() + duration
+    def run(offset):
+        conn = HTTPConnection('127.0.0.1', port, timeout=30)
+        for url in itertools.islice(itertools.cycle(urls), offset, None):
+            if time.monotonic() > deadline:
+                break
+            started = time.perf_counter()
+            try:
+                conn.request('GET', url, headers={'Cookie': cookie})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors[0] += 1
+            except OSError:
+                errors[0] += 1
+                conn = HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            latencies.append(time.perf_counter() - started)
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put((latencies, errors[0]))
+
+def load(port, cookie, urls, concurrency, duration):
+    # the load generator runs in several processes so it isn't the bottleneck
+    processes = min(4, concurrency)
+    results = mp.Queue()
+    clients = [mp.Process(target=_client, args=(port, cookie, urls, concurrency // processes, duration, results))
+               for _ in range(processes)]
+    for client in clients:
+        client.start()
+    latencies, errors = [], 0
+    for _ in clients:
+        l, e = results.get()
+        latencies += l
+        errors += e
+    for client in clients:
+        client.join()
+    return {'requests_per_second': len(latencies) / duration, **percentiles(latencies), 'errors': errors}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='server processes for both modes')
+    parser.add_argument('--threads', type=int, default=8, help='threads per gthread worker')
+    parser.add_argument('--concurrency', type=int, default=64, help='simultaneous client connections')
+    parser.add_argument('--duration', type=float, default=15, help='seconds of load per mode')
+    parser.add_argument('--db-latency-ms', type=float, default=2, help='simulated database round trip per statement')
+    parser.add_argument('--modes', default='sync,gthread')
+    add_json_argument(parser)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        database_uri = f'sqlite:///{os.path.join(folder, "bench.db")}'
+        cookie, urls = prepare(database_uri)
+        env = dict(os.environ, BENCH_DATABASE_URI=database_uri, BENCH_DB_LATENCY_MS=str(args.db_latency_ms),
+                   SECRET_KEY=os.getenv('SECRET_KEY') or 'bench', UPLOAD_FOLDER=folder,
+                   PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        print(f'{args.workers} worker(s) x {args.threads} thread(s), {args.concurrency} connections, {args.duration:.0f}s per mode, '
+              f'{args.db_latency_ms}ms per statement')
+        for mode in args.modes.split(','):
+            port = _free_port()
+            # started outside the repo so gunicorn doesn't pick up gunicorn.conf.py
+            server = subprocess.Popen(COMMANDS[mode](port, args.workers, args.threads), env=env, cwd=folder)
+            try:
+                _wait_ready(port)
+                result = results[mode] = load(port, cookie, urls, args.concurrency, args.duration)
+            finally:
+                server.terminate()
+                server.wait()
+            print(f'{mode}: {result["requests_per_second"]:8.1f} req/s  p50 {result["p50_ms"]:7.1f}ms  '
+                  f'p99 {result["p99_ms"]:7.1f}ms  errors {result["errors"]}')
+    write_json(args.json, 'serving', args, results)
+
+if __name__ == '__main__':
+    main()
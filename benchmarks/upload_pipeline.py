@@ -0,0 +1,90 @@
+"""Compare the old disk round trip + full decode with the in-memory reduced decode.
+
+For each large JPEG/PNG input, every variant runs in a freshly spawned
+process so its peak RSS can be measured on its own.
+
+    python -m benchmarks.upload_pipeline [--with-model] [--json upload_pipeline.json]
+"""
+from .common import add_json_argument, write_json
+from website.uploads import open_reduced
+from PIL import Image
+import argparse, io, multiprocessing as mp, os, tempfile, time
+
+INPUTS = {
+    'jpeg_24mp': ((6000, 4000), 'JPEG'),
+    'jpeg_12mp': ((4000, 3000), 'JPEG'),
+    'png_6mp': ((3000, 2000), 'PNG'),
+}
+
+def make_image(size, fmt):
+    # noise so the encoders can't shrink it to nothing
+    image = Image.merge('RGB', [Image.effect_noise(size, sigma) for sigma in (40, 60, 80)])
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, quality=90)
+    return buffer.getvalue()
+
+def disk_full_decode(data, edge, folder):
+    path = os.path.join(folder, 'upload')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return Image.open(path).convert('RGB')
+
+def memory_reduced_decode(data, edge, folder):
+    return open_reduced(data, edge)
+
+def read_status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+def reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets VmHWM to the current RSS
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    return read_status_kb('VmRSS')
+
+def _child(variant, data, edge, with_model, conn):
+    if with_model:
+        # load the weights first so neither the load time nor its memory is counted
+        from website.model_registry import model_registry
+        from website.detection import detect_batch
+        model_registry.get()
+    baseline = reset_peak_rss()
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as folder:
+        image = variant(data, edge, folder)
+        if with_model:
+            detect_batch([image])
+    elapsed = time.perf_counter() - started
+    peak = read_status_kb('VmHWM') - baseline
+    conn.send((elapsed, peak, image.size))
+
+def measure(variant, data, edge, with_model):
+    ctx = mp.get_context('spawn')
+    parent, child = ctx.Pipe()
+    process = ctx.Process(target=_child, args=(variant, data, edge, with_model, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--edge', type=int, default=512, help='shortest edge the model resizes to')
+    parser.add_argument('--with-model', action='store_true', help='include the YOLOS forward pass (needs torch)')
+    add_json_argument(parser)
+    args = parser.parse_args()
+
+    results = {}
+    for name, (size, fmt) in INPUTS.items():
+        data = make_image(size, fmt)
+        print(f'{name} ({len(data) / 2**20:.1f} MB)')
+        for variant in (disk_full_decode, memory_reduced_decode):
+            elapsed, peak_kb, decoded = measure(variant, data, args.edge, args.with_model)
+            results.setdefault(name, {})[variant.__name__] = {'elapsed_ms': 1000 * elapsed, 'peak_rss_delta_kb': peak_kb}
+            print(f'  {variant.__name__:22} {1000 * elapsed:8.1f}ms  peak +{peak_kb / 1024:6.1f} MB  decoded {decoded[0]}x{decoded[1]}')
+    write_json(args.json, 'upload_pipeline', args, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+
+# create the app once in the master
+preload_app = True
+
+def when_ready(server):
+    # one detection pool per host, started before any worker is forked so they all share its
+    # queue; its supervisor loads the model once and its workers share it copy-on-write
+    server.app.wsgi().extensions['detection'].start()
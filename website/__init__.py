@@ -1,16 +1,60 @@
 from flask import Flask
-from .models import db, User
+from .models import db
+from .principal import principal_cache
+from .database import engine_options, init_engines
+from .detection import detection_pool, verdict_cache
+from .model_registry import model_registry
+from .commands import register_commands
+from .instrumentation import instrumentation
+from .uploads import upload_writer, UploadRequest
+from .renditions import renditions
+from .feed_cache import feed_cache
+from .deletion import deletion
+from .audit import audit_log
 from dotenv import load_dotenv
 from flask_login import LoginManager
-import os
+import os, time
 from uuid import UUID
 
-def create_app():
+def create_app(test_config=None):
+    started = time.perf_counter()
     app = Flask(__name__)
+    # multipart uploads are parsed into memory rather than a temp file, see read_upload
+    app.request_class = UploadRequest
 
     load_dotenv()
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
     app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER')
+    app.config['UPLOAD_MAX_BYTES'] = int(os.getenv('UPLOAD_MAX_BYTES', 10 * 2**20))
+    app.config['UPLOAD_WEB_EDGE'] = int(os.getenv('UPLOAD_WEB_EDGE', 1600))
+    app.config['UPLOAD_WRITERS'] = int(os.getenv('UPLOAD_WRITERS', 2))
+    app.config['RENDITION_WIDTHS'] = [int(w) for w in os.getenv('RENDITION_WIDTHS', '320,640,1280').split(',')]
+    # hard cap on the request body, with some room for the rest of the form
+    app.config['MAX_CONTENT_LENGTH'] = app.config['UPLOAD_MAX_BYTES'] + 2**20
+    app.config['FEED_PAGE_SIZE'] = int(os.getenv('FEED_PAGE_SIZE', 24))
+    app.config['SEARCH_PAGE_SIZE'] = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+    app.config['FEED_CACHE_SIZE'] = int(os.getenv('FEED_CACHE_SIZE', 2048))
+    app.config['FEED_CACHE_TTL'] = int(os.getenv('FEED_CACHE_TTL', 60))
+    app.config['FEED_CACHE_REDIS_URL'] = os.getenv('FEED_CACHE_REDIS_URL')
+    # the in-process LRU, only safe with a single worker process
+    app.config['FEED_CACHE_LOCAL'] = os.getenv('FEED_CACHE_LOCAL', '0') == '1'
+    app.config['PRINCIPAL_CACHE_TTL'] = int(os.getenv('PRINCIPAL_CACHE_TTL', 10))
+    app.config['DETECTION_WORKERS'] = int(os.getenv('DETECTION_WORKERS', 2))
+    app.config['DETECTION_QUEUE_SIZE'] = int(os.getenv('DETECTION_QUEUE_SIZE', 32))
+    app.config['DETECTION_MAX_BATCH_SIZE'] = int(os.getenv('DETECTION_MAX_BATCH_SIZE', 8))
+    app.config['DETECTION_MAX_WAIT_MS'] = int(os.getenv('DETECTION_MAX_WAIT_MS', 10))
+    app.config['DETECTION_CACHE_SIZE'] = int(os.getenv('DETECTION_CACHE_SIZE', 1024))
+    app.config['DETECTION_MODEL'] = os.getenv('DETECTION_MODEL', 'hustvl/yolos-tiny')
+    app.config['DETECTION_MODEL_VARIANT'] = os.getenv('DETECTION_MODEL_VARIANT', 'default')
+    app.config['DETECTION_JOB_TIMEOUT'] = int(os.getenv('DETECTION_JOB_TIMEOUT', 120))
+    app.config['AUDIT_MIN_SCORE'] = float(os.getenv('AUDIT_MIN_SCORE', 0.1))
+    app.config['AUDIT_BATCH_SIZE'] = int(os.getenv('AUDIT_BATCH_SIZE', 100))
+    app.config['AUDIT_FLUSH_SECONDS'] = float(os.getenv('AUDIT_FLUSH_SECONDS', 5))
+    app.config['ADMIN_HANDLES'] = [h for h in os.getenv('ADMIN_HANDLES', '').split(',') if h]
+    app.config['INSTRUMENTATION'] = os.getenv('INSTRUMENTATION', '0') == '1'
+    app.config['PROFILE_SLOW_REQUESTS_MS'] = int(os.getenv('PROFILE_SLOW_REQUESTS_MS', 0))
+    app.config['PROFILE_SAMPLE_INTERVAL_MS'] = int(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', 5))
+    app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', 'profiles')
     DB_USER = os.getenv('DB_USER')
     DB_PASS = os.getenv('DB_PASS')
     DB_HOST = os.getenv('DB_HOST')
@@ -18,12 +62,39 @@ def create_app():
     DB_NAME = os.getenv('DB_NAME')
     app.config['SQLALCHEMY_DATABASE_URI'] \
         = f'postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}' 
+    app.config['DB_REPLICA_URI'] = os.getenv('DB_REPLICA_URI')
+    app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 5))
+    app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 5))
+    app.config['DB_POOL_TIMEOUT'] = int(os.getenv('DB_POOL_TIMEOUT', 10))
+    app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', 1800))
+    app.config['DB_POOL_PRE_PING'] = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+    app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))
+    app.config['DB_PGBOUNCER'] = os.getenv('DB_PGBOUNCER', '0') == '1'
+    if test_config is not None:
+        app.config.update(test_config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    if app.config['DB_REPLICA_URI']:
+        app.config.setdefault('SQLALCHEMY_BINDS', {'replica': app.config['DB_REPLICA_URI']})
     db.init_app(app)
+    init_engines(app, db)
+    model_registry.init_app(app)
+    detection_pool.init_app(app)
+    verdict_cache.init_app(app)
+    instrumentation.init_app(app)
+    upload_writer.init_app(app)
+    renditions.init_app(app)
+    feed_cache.init_app(app)
+    principal_cache.init_app(app)
+    deletion.init_app(app)
+    audit_log.init_app(app)
     
+    imports_started = time.perf_counter()
     from .views import views
     from .auth import auth
+    import_time = time.perf_counter() - imports_started
     app.register_blueprint(views, url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
+    register_commands(app)
     
     with app.app_context():
         db.create_all() 
@@ -39,6 +110,13 @@ def create_app():
         except ValueError:
             return None
     
-        return User.query.get(id)
+        # id, handle, pfp_url and strikes only, from a short-lived cache
+        return principal_cache.load(id)
 
+    app.extensions['startup_timings'] = {
+        'import_views_ms': 1000 * import_time,
+        'create_app_ms': 1000 * (time.perf_counter() - started),
+    }
+    app.logger.info('create_app finished in %.0fms (views import %.0fms)',
+                    app.extensions['startup_timings']['create_app_ms'], app.extensions['startup_timings']['import_views_ms'])
     return app
\ No newline at end of file
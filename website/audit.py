@@ -0,0 +1,176 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from datetime import datetime
+from .models import db, DetectionAudit, DetectionAuditLabel
+from .model_registry import model_registry
+import threading, atexit, uuid, os, logging
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class AuditLog:
+    """Keeps every detection verdict with all the labels and scores behind it.
+
+    `record` is called while the verdict is applied; the row is buffered
+    once that transaction commits and a background thread inserts the
+    buffer with one executemany per table every AUDIT_BATCH_SIZE rows or
+    AUDIT_FLUSH_SECONDS, so the upload path never waits on the log.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self._rows = []
+        self.batch_size = 100
+        self.flush_interval = 5
+        self.max_buffered = 10000
+        self.written = 0
+        self.dropped = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from .detection import DETECTION_THRESHOLD
+
+        self.app = app
+        self.threshold = DETECTION_THRESHOLD
+        self.min_score = min(app.config.get('AUDIT_MIN_SCORE', DETECTION_THRESHOLD), DETECTION_THRESHOLD)
+        self.batch_size = app.config.get('AUDIT_BATCH_SIZE', self.batch_size)
+        self.flush_interval = app.config.get('AUDIT_FLUSH_SECONDS', self.flush_interval)
+        app.extensions['audit_log'] = self
+
+        if not event.contains(Session, 'after_commit', _after_commit):
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+            atexit.register(self.flush)
+
+    def record(self, job, scores, error=None, cached=False, queue_ms=None, inference_ms=None, batch_size=None):
+        """Log the verdict on `job` once the current transaction commits."""
+        row = {
+            'id': uuid.uuid4(), 'job_id': job.id, 'kind': job.kind, 'user_id': job.user_id, 'post_id': job.post_id,
+            'content_hash': job.content_hash, 'verdict': job.status, 'error': error and error[:300], 'cached': cached,
+            'model_name': model_registry.key, 'threshold': self.threshold,
+            # a cached verdict only kept the labels above the threshold
+            'min_score': self.threshold if cached else self.min_score,
+            'queue_ms': queue_ms, 'inference_ms': inference_ms, 'batch_size': batch_size, 'timestamp': datetime.utcnow(),
+        }
+        labels = [{'audit_id': row['id'], 'label': label, 'score': score} for label, score in (scores or {}).items()]
+        db.session.info.setdefault('detection_audit', []).append((row, labels))
+
+    def _add(self, entries):
+        with self._lock:
+            if self._pid != os.getpid():
+                # rows buffered before a fork are the parent's to write
+                self._pid = os.getpid()
+                self._rows = []
+                threading.Thread(target=self._run, daemon=True).start()
+            self._rows.extend(entries)
+            overflow = len(self._rows) - self.max_buffered
+            if overflow > 0:
+                del self._rows[:overflow]
+                self.dropped += overflow
+            if len(self._rows) >= self.batch_size:
+                self._wake.set()
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pid != os.getpid() or not self._rows:
+                return
+            entries, self._rows = self._rows, []
+        rows = [row for row, _ in entries]
+        labels = [label for _, row_labels in entries for label in row_labels]
+        try:
+            with self.app.app_context(), db.engine.begin() as conn:
+                conn.execute(db.insert(DetectionAudit), rows)
+                if labels:
+                    conn.execute(db.insert(DetectionAuditLabel), labels)
+            self.written += len(rows)
+        except Exception:
+            self.dropped += len(rows)
+            logger.exception('Could not write %d detection audit rows', len(rows))
+
+    def pending(self):
+        return len(self._rows) if self._pid == os.getpid() else 0
+
+    def report(self, since=None, model_name=None):
+        """Verdict counts, per-label rates and latency percentiles, aggregated by the database."""
+        filters = []
+        if since is not None:
+            filters.append(DetectionAudit.timestamp >= since)
+        if model_name is not None:
+            filters.append(DetectionAudit.model_name == model_name)
+        inferred = [*filters, DetectionAudit.cached.is_(False), DetectionAudit.error.is_(None)]
+
+        verdicts = dict(db.session.execute(db.select(DetectionAudit.verdict, db.func.count())
+                                           .where(*filters).group_by(DetectionAudit.verdict)).all())
+        cached, errors = db.session.execute(db.select(
+            db.func.count().filter(DetectionAudit.cached.is_(True)),
+            db.func.count().filter(DetectionAudit.error.is_not(None)),
+        ).where(*filters)).one()
+        inference_runs = db.session.scalar(db.select(db.func.count()).where(*inferred))
+
+        detected = DetectionAuditLabel.score > DetectionAudit.threshold
+        labels = {}
+        for label, seen, hits, average in db.session.execute(
+                db.select(DetectionAuditLabel.label, db.func.count(), db.func.count().filter(detected),
+                          db.func.avg(DetectionAuditLabel.score))
+                .join(DetectionAudit, DetectionAudit.id == DetectionAuditLabel.audit_id)
+                .where(*inferred).group_by(DetectionAuditLabel.label)):
+            labels[label] = {'detected': hits, 'rate': hits / inference_runs if inference_runs else 0,
+                             'seen': seen, 'avg_score': round(average, 3), 'scores': {}}
+        # how the scores spread around the threshold, in tenths
+        # floor, not a cast: Postgres rounds when casting, which would mix 0.45-0.5 into the 0.5 bucket
+        bucket = db.func.floor(DetectionAuditLabel.score * 10)
+        for label, tenth, count in db.session.execute(
+                db.select(DetectionAuditLabel.label, bucket, db.func.count())
+                .join(DetectionAudit, DetectionAudit.id == DetectionAuditLabel.audit_id)
+                .where(*inferred).group_by(DetectionAuditLabel.label, bucket)):
+            labels[label]['scores'][f'{int(tenth) / 10:.1f}'] = count
+
+        per_image = DetectionAudit.inference_ms / DetectionAudit.batch_size
+        return {
+            'audits': sum(verdicts.values()),
+            'verdicts': verdicts,
+            'inference_runs': inference_runs,
+            'cached': cached,
+            'errors': errors,
+            'labels': dict(sorted(labels.items(), key=lambda item: -item[1]['detected'])),
+            'queue_ms': self._percentiles(DetectionAudit.queue_ms, inferred),
+            'batch_ms': self._percentiles(DetectionAudit.inference_ms, inferred),
+            'per_image_ms': self._percentiles(per_image, inferred),
+        }
+
+    def _percentiles(self, column, filters):
+        if db.session.get_bind().dialect.name == 'postgresql':
+            values = db.session.execute(db.select(*[db.func.percentile_cont(p).within_group(column) for p in PERCENTILES])
+                                        .where(*filters)).one()
+        else:
+            # no percentile_cont elsewhere: count, then read the nearest rank off an ordered scan
+            count = db.session.scalar(db.select(db.func.count(column)).where(*filters))
+            values = [db.session.scalar(db.select(column).where(*filters, column.is_not(None)).order_by(column)
+                                        .offset(round(p * (count - 1))).limit(1)) if count else None
+                      for p in PERCENTILES]
+        return {f'p{int(p * 100)}': round(value, 1) if value is not None else None for p, value in zip(PERCENTILES, values)}
+
+
+audit_log = AuditLog()
+
+
+def _after_commit(session):
+    entries = session.info.pop('detection_audit', None)
+    if entries:
+        audit_log._add(entries)
+
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop('detection_audit', None)
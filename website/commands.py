@@ -0,0 +1,266 @@
+from .models import db, User, Post, Comment, Karma, trigram_installed
+from .renditions import renditions, build_renditions, UPLOADS_PREFIX
+from .detection import DETECTION_THRESHOLD, classify
+from .model_registry import model_registry
+from .feed import SORTS
+from .feed_cache import feed_cache
+from .rescan import init_worker, scan_images, post_changes, Checkpoint, RateLimiter
+from flask.cli import with_appcontext
+from sqlalchemy import exc
+from sqlalchemy.schema import AddConstraint
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+import click, os, time
+
+@click.command('reconcile-karma')
+@click.option('--dry-run', is_flag=True, help='Only report how many counters have drifted.')
+@with_appcontext
+def reconcile_karma(dry_run):
+    """Rebuild Post.score and Comment.score from the raw votes."""
+    _reconcile(dry_run)
+
+def _reconcile(dry_run):
+    for model, column in ((Post, Karma.post_id), (Comment, Karma.comment_id)):
+        total = db.select(db.func.coalesce(db.func.sum(Karma.karma), 0))\
+            .where(column == model.id).scalar_subquery()
+        drifted = model.query.filter(model.score != total).count()
+        if not dry_run and drifted:
+            db.session.execute(db.update(model).where(model.score != total).values(score=total))
+        click.echo(f'{model.__tablename__}: {drifted} score(s) {"out of date" if dry_run else "rebuilt"}')
+    db.session.commit()
+
+@click.command('migrate-karma')
+@click.option('--dry-run', is_flag=True, help='Only list the changes, without touching the database.')
+@with_appcontext
+def migrate_karma(dry_run):
+    """Move a database from the old object_uuid/object_type votes to the typed ones with score counters."""
+    engine = db.engine
+    inspector = db.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    steps = []
+    for model, column in ((Post, Post.status), (Post, Post.score), (Comment, Comment.score)):
+        if column.name not in {c['name'] for c in inspector.get_columns(model.__tablename__)}:
+            default = f"'{column.default.arg}'" if isinstance(column.default.arg, str) else column.default.arg
+            steps.append((f'{model.__tablename__}: add column {column.name}',
+                          f'ALTER TABLE {quote(model.__tablename__)} ADD COLUMN {column.name} '
+                          f'{column.type.compile(engine.dialect)} NOT NULL DEFAULT {default}'))
+
+    karma_columns = {c['name'] for c in inspector.get_columns('karma')}
+    legacy = 'object_uuid' in karma_columns
+    if legacy:
+        uuid_type = Karma.post_id.type.compile(engine.dialect)
+        for target in ('post', 'comment'):
+            if f'{target}_id' not in karma_columns:
+                steps.append((f'karma: add column {target}_id', f'ALTER TABLE karma ADD COLUMN {target}_id {uuid_type}'))
+        for target in ('post', 'comment'):
+            # votes whose object is gone stay NULL here and are dropped below
+            match = 'CAST(karma.object_uuid AS UUID)' if engine.dialect.name == 'postgresql' \
+                else "replace(karma.object_uuid, '-', '')"
+            steps.append((f'karma: fill {target}_id from object_uuid',
+                          f'UPDATE karma SET {target}_id = (SELECT id FROM {quote(target)} WHERE id = {match}) '
+                          f"WHERE karma.object_type = '{target}' OR (karma.object_type IS NULL AND karma.post_id IS NULL)"))
+        steps.append(('karma: drop votes on deleted posts and comments',
+                      'DELETE FROM karma WHERE post_id IS NULL AND comment_id IS NULL'))
+        for target in ('post', 'comment'):
+            # the old routes could record several votes by one user on one object, keep one
+            steps.append((f'karma: drop duplicate votes per user and {target}',
+                          f'DELETE FROM karma WHERE {target}_id IS NOT NULL AND EXISTS (SELECT 1 FROM karma AS other '
+                          f'WHERE other.user_id = karma.user_id AND other.{target}_id = karma.{target}_id AND other.id < karma.id)'))
+        steps.append(('karma: drop column object_type', 'ALTER TABLE karma DROP COLUMN object_type'))
+        steps.append(('karma: drop column object_uuid', 'ALTER TABLE karma DROP COLUMN object_uuid'))
+
+    with engine.begin() as conn:
+        for description, statement in steps:
+            click.echo(description)
+            if not dry_run:
+                conn.exec_driver_sql(statement)
+        if legacy:
+            for constraint in sorted(Karma.__table__.constraints, key=lambda c: [c.name for c in c.columns]):
+                columns = [column.name for column in constraint.columns]
+                if isinstance(constraint, db.PrimaryKeyConstraint) or columns == ['user_id']:
+                    continue
+                name = constraint.name or f'karma({", ".join(columns)}) foreign key'
+                if engine.dialect.name != 'postgresql':
+                    # SQLite cannot add constraints to a table, a unique index still keeps one vote per object
+                    if isinstance(constraint, db.UniqueConstraint):
+                        click.echo(f'karma: add unique index {name}')
+                        if not dry_run:
+                            conn.exec_driver_sql(f'CREATE UNIQUE INDEX {name} ON karma ({", ".join(columns)})')
+                    else:
+                        click.echo(f'karma: skipped {name}, {engine.dialect.name} cannot add constraints', err=True)
+                    continue
+                click.echo(f'karma: add constraint {name}')
+                if not dry_run:
+                    conn.execute(AddConstraint(constraint))
+    click.echo(f'{len(steps)} change(s) {"needed" if dry_run else "applied"}')
+    if not dry_run and steps:
+        _reconcile(dry_run)
+        click.echo('run `flask apply-cascades` for the new indexes')
+
+@click.command('backfill-renditions')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Processes resizing in parallel.')
+@with_appcontext
+def backfill_renditions(workers):
+    """Create the srcset renditions of images uploaded before they existed."""
+    urls = {url for (url,) in db.session.query(Post.image_url)} | {url for (url,) in db.session.query(User.pfp_url)}
+    filenames = sorted(url[len(UPLOADS_PREFIX):] for url in urls if url.startswith(UPLOADS_PREFIX))
+    filenames = [f for f in filenames if os.path.exists(os.path.join(renditions.folder, f))]
+    created = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(build_renditions, renditions.folder, f, renditions.widths, renditions.format): f
+                   for f in filenames}
+        for future in as_completed(futures):
+            try:
+                created += future.result()
+            except Exception as e:
+                failed += 1
+                click.echo(f'{futures[future]}: {e}', err=True)
+    click.echo(f'{len(filenames)} image(s) checked, {created} rendition(s) created, {failed} failed')
+
+@click.command('apply-cascades')
+@click.option('--dry-run', is_flag=True, help='Only list the foreign keys and indexes that are out of date.')
+@with_appcontext
+def apply_cascades(dry_run):
+    """Bring an existing database's ON DELETE rules and indexes up to the models."""
+    engine = db.engine
+    inspector = db.inspect(engine)
+    changed = 0
+    with engine.begin() as conn:
+        if engine.dialect.name == 'postgresql' and not dry_run and not trigram_installed(conn):
+            # for the handle typeahead index; needs CREATE on the database, so only ever done here
+            try:
+                with conn.begin_nested():
+                    conn.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            except exc.DBAPIError as e:
+                click.echo(f'could not install pg_trgm, handle search falls back to substring matching: {e.orig}', err=True)
+        for table in db.metadata.sorted_tables:
+            existing = {tuple(fk['constrained_columns']): fk for fk in inspector.get_foreign_keys(table.name)}
+            for constraint in table.foreign_key_constraints:
+                columns = tuple(constraint.column_keys)
+                current = existing.get(columns)
+                if current is None or (current['options'].get('ondelete') or '').upper() == (constraint.ondelete or '').upper():
+                    continue
+                changed += 1
+                click.echo(f'{table.name}({", ".join(columns)}): ON DELETE {current["options"].get("ondelete") or "NO ACTION"} -> {constraint.ondelete}')
+                if dry_run:
+                    continue
+                if engine.dialect.name != 'postgresql':
+                    raise click.ClickException(f'{engine.dialect.name} cannot alter constraints, recreate the database with db.create_all()')
+                target = constraint.elements[0].column.table.name
+                conn.exec_driver_sql(
+                    f'ALTER TABLE "{table.name}" DROP CONSTRAINT "{current["name"]}", '
+                    f'ADD CONSTRAINT "{current["name"]}" FOREIGN KEY ({", ".join(columns)}) '
+                    f'REFERENCES "{target}" ({", ".join(e.column.name for e in constraint.elements)}) ON DELETE {constraint.ondelete}')
+
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                # the search indexes (the ones with postgresql_ options) only exist on Postgres
+                if engine.dialect.name != 'postgresql' and any(key.startswith('postgresql_') for key in index.dialect_kwargs):
+                    continue
+                if index.name not in indexes:
+                    trigram = 'gin_trgm_ops' in (index.dialect_options['postgresql']['ops'] or {}).values()
+                    if not dry_run and trigram and not trigram_installed(conn):
+                        click.echo(f'{table.name}: skipped index {index.name}, pg_trgm is not installed')
+                        continue
+                    changed += 1
+                    click.echo(f'{table.name}: missing index {index.name}')
+                    if not dry_run:
+                        index.create(conn)
+    click.echo(f'{changed} change(s) {"needed" if dry_run else "applied"}')
+
+@click.command('rescan')
+@click.option('--workers', default=2, show_default=True, help='Processes running the model.')
+@click.option('--batch-size', default=8, show_default=True, help='Images per forward pass.')
+@click.option('--chunk', default=500, show_default=True, help='Rows read, and written back, at a time.')
+@click.option('--checkpoint', default='rescan-checkpoint.json', show_default=True, help='Where progress is saved.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint and start over.')
+@click.option('--max-rate', default=0.0, help='Images per second at most, to leave room for live traffic.')
+@click.option('--only', type=click.Choice(['posts', 'pfps']), help='Scan one kind of image.')
+@click.option('--status', 'statuses', multiple=True, default=['published'], show_default=True,
+              type=click.Choice(['published', 'flagged']), help='Post statuses to rescan, repeatable. Pending posts are never touched.')
+@click.option('--dry-run', is_flag=True, help='Only report the verdicts that would change.')
+@with_appcontext
+def rescan(workers, batch_size, chunk, checkpoint, restart, max_rate, only, statuses, dry_run):
+    """Re-run detection over every uploaded post and profile picture, e.g. after changing the model.
+
+    Posts that now contain a table are flagged (hidden from the feed) instead
+    of banning anyone after the fact; profile pictures with one are reset.
+    Only published posts are scanned unless `--status flagged` asks to re-check
+    (and possibly clear) the flagged ones too; pending posts belong to the live
+    detection pool.
+    """
+    try:
+        # loaded before the workers fork so they share the weights
+        model_registry.get()
+    except ImportError:
+        raise click.ClickException('rescan needs torch and transformers installed')
+
+    progress = Checkpoint(checkpoint, model_registry.key, DETECTION_THRESHOLD)
+    if not restart and not progress.load():
+        raise click.ClickException(f'{checkpoint} was written for another model or threshold, pass --restart')
+    default_pfp = User.pfp_url.default.arg
+    tables = {
+        'posts': (Post, db.select(Post.id, Post.image_url, Post.status, Post.contains_chair)
+                  .where(Post.image_url.startswith(UPLOADS_PREFIX), Post.status.in_(statuses)),
+                  lambda row, found: post_changes((row.id, row.status, row.contains_chair), found)),
+        'pfps': (User, db.select(User.id, User.pfp_url.label('image_url')).where(User.pfp_url.startswith(UPLOADS_PREFIX)),
+                 lambda row, found: {'id': row.id, 'pfp_url': default_pfp} if classify(found)[0] else None),
+    }
+    limiter = RateLimiter(max_rate)
+    started = time.perf_counter()
+    scanned = changed = failed = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork'),
+                             initializer=init_worker, initargs=(max(1, os.cpu_count() // workers),)) as executor:
+        for table, (model, query, changes_for) in tables.items():
+            if only not in (None, table):
+                continue
+            last = progress.state['last'].get(table)
+            while True:
+                rows = db.session.execute((query.where(model.id > last) if last else query).order_by(model.id).limit(chunk)).all()
+                if not rows:
+                    break
+                by_id = {row.id: row for row in rows}
+                items = [(row.id, row.image_url[len(UPLOADS_PREFIX):]) for row in rows]
+                futures = []
+                for i in range(0, len(items), batch_size):
+                    limiter.wait(len(items[i:i + batch_size]))
+                    futures.append(executor.submit(scan_images, renditions.folder, items[i:i + batch_size]))
+
+                updates = []
+                for future in as_completed(futures):
+                    for row_id, detection_dict, error in future.result():
+                        if error is not None:
+                            failed += 1
+                            click.echo(f'{table} {row_id}: {error}', err=True)
+                            continue
+                        update = changes_for(by_id[row_id], detection_dict)
+                        if update is not None:
+                            updates.append(update)
+                            if dry_run:
+                                click.echo(f'{table} {row_id}: ' + ', '.join(f'{k}={v}' for k, v in update.items() if k != 'id'))
+                if updates and not dry_run:
+                    db.session.execute(db.update(model), updates)
+                    db.session.commit()
+                    feed_cache.invalidate(SORTS)
+
+                last = rows[-1].id
+                scanned += len(rows)
+                changed += len(updates)
+                if not dry_run:
+                    progress.state['last'][table] = str(last)
+                    progress.state['scanned'] += len(rows)
+                    progress.state['changed'] += len(updates)
+                    progress.save()
+                elapsed = time.perf_counter() - started
+                click.echo(f'{table}: {scanned} scanned, {changed} changed, {failed} failed, {scanned / elapsed:.1f} images/s')
+
+    elapsed = time.perf_counter() - started
+    click.echo(f'{scanned} image(s) in {elapsed:.1f}s ({scanned / elapsed if elapsed else 0:.1f} images/s), '
+               f'{changed} verdict(s) {"would change" if dry_run else "changed"}, {failed} failed')
+
+def register_commands(app):
+    app.cli.add_command(reconcile_karma)
+    app.cli.add_command(migrate_karma)
+    app.cli.add_command(backfill_renditions)
+    app.cli.add_command(apply_cascades)
+    app.cli.add_command(rescan)
@@ -0,0 +1,92 @@
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool, NullPool
+from functools import wraps
+import time, os
+
+
+class RoutingSession(Session):
+    """Sends the reads of views marked `@use_replica` to the `replica` bind, when there is one."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('use_replica') \
+                and 'replica' in self._db.engines:
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def use_replica(view):
+    """Route a read-only view's queries to DB_REPLICA_URI. Replicas lag, so never use it on a view that writes."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_replica = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g.use_replica = False
+    return wrapper
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        from .instrumentation import instrumentation
+
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            instrumentation.metrics.inc('tables_db_pool_timeouts_total')
+            raise
+        finally:
+            if instrumentation.enabled:
+                instrumentation.metrics.observe('tables_db_pool_checkout_wait_seconds', time.perf_counter() - started)
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for Postgres from the DB_* settings; other databases keep their defaults."""
+    if not config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        return {}
+
+    connect_args = {'application_name': 'tables'}
+    if config['DB_PGBOUNCER']:
+        # PgBouncer (transaction pooling) owns the pool; session level settings
+        # would leak between clients, so the timeout is set per transaction
+        return {'poolclass': NullPool, 'connect_args': connect_args}
+
+    if config['DB_STATEMENT_TIMEOUT_MS']:
+        connect_args['options'] = f'-c statement_timeout={config["DB_STATEMENT_TIMEOUT_MS"]}'
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'connect_args': connect_args,
+    }
+
+def init_engines(app, db):
+    """Per-engine setup once `db.init_app` has created the engines."""
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    timeout = app.config.get('DB_STATEMENT_TIMEOUT_MS')
+    if app.config.get('DB_PGBOUNCER') and timeout:
+        for engine in engines:
+            @event.listens_for(engine, 'begin')
+            def set_statement_timeout(conn, timeout=int(timeout)):
+                conn.exec_driver_sql(f'SET LOCAL statement_timeout = {timeout}')
+
+    for engine in engines:
+        if engine.dialect.name == 'sqlite':
+            # SQLite only enforces foreign keys, and so ON DELETE CASCADE, when asked to
+            @event.listens_for(engine, 'connect')
+            def enable_foreign_keys(dbapi_connection, connection_record):
+                dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
+    # connections opened before a fork (db.create_all in the gunicorn master,
+    # detection workers) must not be shared with the child, start it on a fresh pool
+    os.register_at_fork(after_in_child=lambda: [engine.dispose(close=False) for engine in engines])
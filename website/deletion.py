@@ -0,0 +1,119 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor
+from .models import db, User, Post, Comment, Karma, DetectionJob
+from .feed import SORTS
+from .feed_cache import feed_cache
+from .principal import principal_cache
+from .renditions import UPLOADS_PREFIX
+import threading, glob, os, re, logging
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_STEM = re.compile(r'^[0-9a-f]{32}')
+
+
+class DeletionService:
+    """Deletes users and posts with a handful of set-based statements.
+
+    Comments, votes and posts go through the database's ON DELETE CASCADE
+    instead of being loaded and deleted one by one, so banning a heavy user
+    costs the same few round trips as banning a new one. Uploaded files are
+    removed in the background after the commit, unless a deduplicated upload
+    still points at them.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.folder = app.config['UPLOAD_FOLDER']
+        app.extensions['deletion'] = self
+
+        if not event.contains(Session, 'after_commit', _after_commit):
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+
+    def delete_user(self, user_id):
+        """Delete a user and everything they made, in the current transaction."""
+        posts = db.session.query(Post.id, Post.image_url).filter_by(user_id=user_id).all()
+        urls = {url for _, url in posts}
+        urls.update(url for (url,) in db.session.query(User.pfp_url).filter_by(id=user_id))
+
+        # their votes on everyone else's posts and comments go away with them, take them out of the scores
+        for model, column in ((Post, Karma.post_id), (Comment, Karma.comment_id)):
+            votes = db.select(db.func.coalesce(db.func.sum(Karma.karma), 0))\
+                .where(Karma.user_id == user_id, column == model.id).scalar_subquery()
+            db.session.execute(db.update(model)
+                               .where(model.id.in_(db.select(column).where(Karma.user_id == user_id)))
+                               .values(score=model.score - votes),
+                               execution_options={'synchronize_session': False})
+        db.session.execute(db.delete(User).where(User.id == user_id))
+        self._pending(urls, post_ids={post_id for post_id, _ in posts}, user_ids={user_id})
+
+    def delete_post(self, post_id):
+        """Delete a post with its comments and votes, in the current transaction."""
+        urls = {url for (url,) in db.session.query(Post.image_url).filter_by(id=post_id)}
+        db.session.execute(db.delete(Post).where(Post.id == post_id))
+        self._pending(urls, post_ids={post_id})
+
+    def _pending(self, urls, post_ids=(), user_ids=()):
+        uploads, posts, users = db.session.info.setdefault('deletions', (set(), set(), set()))
+        uploads.update(url for url in urls if url.startswith(UPLOADS_PREFIX))
+        posts.update(post_ids)
+        users.update(user_ids)
+
+    def _committed(self, uploads, post_ids, user_ids):
+        # bulk statements bypass the session events the caches listen to
+        feed_cache.invalidate(SORTS, post_ids)
+        principal_cache.invalidate(user_ids)
+        if uploads and self.folder:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-reaper')
+            self._executor.submit(self._remove_uploads, uploads)
+
+    def _remove_uploads(self, urls):
+        with self.app.app_context():
+            for url in urls:
+                if self._referenced(url):
+                    continue
+                stem = UPLOAD_STEM.match(url[len(UPLOADS_PREFIX):])
+                if stem is None:
+                    continue
+                # the original, its web copy and the srcset renditions all share the stem
+                for path in glob.glob(os.path.join(self.folder, stem.group() + '*')):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        logger.exception('Could not remove upload %s', path)
+
+    def _referenced(self, url):
+        # a re-upload of the same bytes reuses the stored file, see views.store_upload
+        return db.session.query(
+            db.session.query(Post.id).filter_by(image_url=url).exists()
+            | db.session.query(User.id).filter_by(pfp_url=url).exists()
+            | db.session.query(DetectionJob.id).filter_by(image_url=url, status='pending').exists()
+        ).scalar()
+
+
+deletion = DeletionService()
+
+
+def _after_commit(session):
+    deleted = session.info.pop('deletions', None)
+    if deleted is not None:
+        try:
+            deletion._committed(*deleted)
+        except Exception:
+            logger.exception('Could not schedule cleanup after a delete')
+
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop('deletions', None)
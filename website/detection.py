@@ -0,0 +1,414 @@
+from .models import db, DetectionJob, DetectionCache
+from .model_registry import model_registry
+from .uploads import open_reduced
+from .deletion import deletion
+from .audit import audit_log
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from multiprocessing import connection as mp_connection
+import multiprocessing as mp
+import threading, queue, signal, time, sys, os, logging
+
+DETECTION_THRESHOLD = 0.5
+
+logger = logging.getLogger(__name__)
+
+def model_input_edge(image_processor):
+    # shortest edge the processor resizes to; anything decoded beyond it is wasted
+    size = getattr(image_processor, 'size', None)
+    if isinstance(size, dict):
+        return size.get('shortest_edge', 800)
+    return size or 800
+
+def detect_batch(images, timings=None, min_score=DETECTION_THRESHOLD):
+    """`{label: best score}` for each image, keeping every detection scoring above `min_score`."""
+    import torch
+
+    timings = {} if timings is None else timings
+    model, image_processor = model_registry.get()
+    started = time.perf_counter()
+    # the processor pads every image to the largest one in the batch before stacking
+    inputs = image_processor(images=images, return_tensors="pt")
+    timings['preprocess'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with torch.inference_mode():
+        outputs = model(**inputs)
+    timings['forward'] = time.perf_counter() - started
+
+    # convert outputs (bounding boxes and class logits) to COCO API
+    started = time.perf_counter()
+    target_sizes = torch.tensor([image.size[::-1] for image in images])
+    batch_results = image_processor.post_process_object_detection(outputs, threshold=min_score, target_sizes=target_sizes)
+
+    detection_dicts = []
+    for results in batch_results:
+        detection_dict = {}
+        for score, label, box in zip(results["scores"], results["labels"], results["boxes"]):
+            label_name = model.config.id2label[label.item()]
+            confidence = round(score.item(), 3)
+            detection_dict[label_name] = max(confidence, detection_dict.get(label_name, 0))
+        detection_dicts.append(detection_dict)
+    timings['postprocess'] = time.perf_counter() - started
+
+    return detection_dicts
+
+def above_threshold(scores):
+    return {label: score for label, score in scores.items() if score > DETECTION_THRESHOLD}
+
+def classify(detection_dict):
+    contains_table = any("table" in label or "bench" in label for label in detection_dict.keys())
+    contains_chair = not detection_dict or any("chair" in label for label in detection_dict.keys())
+    return contains_table, contains_chair
+
+def _collect_batch(jobs, max_batch_size, max_wait):
+    """Block for one job, then coalesce whatever else arrives within `max_wait` seconds."""
+    batch = [jobs.get()]
+    deadline = time.monotonic() + max_wait
+    while batch[-1] is not None and len(batch) < max_batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(jobs.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def _worker_main(jobs, results, max_batch_size, max_wait, min_score, threads):
+    try:
+        import torch
+        # the workers share the cores, keep torch from starting a thread per core in each
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    while True:
+        batch = _collect_batch(jobs, max_batch_size, max_wait)
+        stop = batch[-1] is None
+        if stop:
+            batch.pop()
+
+        started = time.time()
+        timings = {}
+        verdicts = []
+        images = []
+        loaded = []
+        try:
+            # loaded here rather than before the loop, so a model that can't load fails its jobs instead of the process
+            _, image_processor = model_registry.get()
+        except Exception as e:
+            if batch:
+                results.put(([(job_id, None, repr(e), started - queued_at) for job_id, _, queued_at in batch], 0, {}))
+            if stop:
+                break
+            continue
+        edge = model_input_edge(image_processor)
+        for job_id, data, queued_at in batch:
+            try:
+                images.append(open_reduced(data, edge))
+                loaded.append((job_id, started - queued_at))
+            except Exception as e:
+                verdicts.append((job_id, None, repr(e), started - queued_at))
+        timings['decode'] = time.time() - started
+
+        if images:
+            try:
+                # scores below the threshold are kept for the audit log, the verdict only uses the rest
+                detection_dicts = detect_batch(images, timings, min_score)
+                verdicts.extend((job_id, detection_dict, None, delay) for (job_id, delay), detection_dict in zip(loaded, detection_dicts))
+            except Exception as e:
+                verdicts.extend((job_id, None, repr(e), delay) for job_id, delay in loaded)
+        if verdicts:
+            results.put((verdicts, len(images), timings))
+        if stop:
+            break
+
+class VerdictCache:
+    """In-process LRU in front of the persistent `DetectionCache` table."""
+
+    def __init__(self, app=None, size=1024):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.size = app.config.get('DETECTION_CACHE_SIZE', self.size)
+
+    def _remember(self, content_hash, entry):
+        with self._lock:
+            self._entries[content_hash] = entry
+            self._entries.move_to_end(content_hash)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get(self, content_hash):
+        """Return `(detection_dict, image_url)` for a known image, otherwise None."""
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            if entry is not None:
+                self._entries.move_to_end(content_hash)
+                self.hits += 1
+                return entry
+
+        cached = db.session.get(DetectionCache, (content_hash, model_registry.key, DETECTION_THRESHOLD))
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry = (cached.detections, cached.image_url)
+        self._remember(content_hash, entry)
+        return entry
+
+    def put(self, content_hash, detection_dict, image_url):
+        contains_table, contains_chair = classify(detection_dict)
+        db.session.merge(DetectionCache(content_hash=content_hash, model_name=model_registry.key, threshold=DETECTION_THRESHOLD,
+                                        detections=detection_dict, contains_table=contains_table,
+                                        contains_chair=contains_chair, image_url=image_url))
+        self._remember(content_hash, (detection_dict, image_url))
+
+
+verdict_cache = VerdictCache()
+
+
+def apply_verdict(job_id, detection_dict, error=None, cached=False, scores=None, measurements=None):
+    """Publish or reject a job. `scores` are all the labels the model saw, `measurements` its timings, both for the audit log."""
+    # locked: every web process runs a collector and a sweep, only one of them may settle a job
+    job = DetectionJob.query.filter_by(id=job_id).with_for_update().first()
+    if job is None or job.status != 'pending':
+        return
+    user = job.user
+
+    if user is None or error is not None:
+        logger.warning('Detection job %s failed: %s', job_id, error)
+        job.status = 'failed'
+        job.message = 'We could not check your image, please try again.'
+        audit_log.record(job, scores, error=error or 'user deleted', cached=cached, **(measurements or {}))
+        if job.post is not None:
+            deletion.delete_post(job.post_id)
+        db.session.commit()
+        return
+
+    if job.content_hash is not None and not cached:
+        verdict_cache.put(job.content_hash, detection_dict, job.image_url)
+
+    contains_table, contains_chair = classify(detection_dict)
+    if contains_table:
+        # Delete the user who posted the table
+        job.status = 'rejected_table'
+        deletion.delete_user(user.id)
+    elif job.kind == 'post':
+        if user.strikes >= 2:
+            job.status = 'rejected_strike'
+            deletion.delete_user(user.id)
+        else:
+            job.status = 'published'
+            job.post.publish(contains_chair)
+            if not contains_chair:
+                job.message = f'You have {3 - user.strikes} strikes left.'
+    else:
+        job.status = 'published'
+        user.pfp_url = job.image_url
+    audit_log.record(job, detection_dict if scores is None else scores, cached=cached, **(measurements or {}))
+    db.session.commit()
+
+
+def expire_jobs(timeout, job_id=None):
+    """Fail the jobs still pending after `timeout` seconds, e.g. because the worker holding them died."""
+    query = db.select(DetectionJob.id).where(DetectionJob.status == 'pending',
+                                             DetectionJob.timestamp < datetime.utcnow() - timedelta(seconds=timeout))
+    if job_id is not None:
+        query = query.where(DetectionJob.id == job_id)
+    for expired in db.session.scalars(query).all():
+        apply_verdict(expired, None, error=f'no verdict after {timeout}s')
+
+
+class DetectionStats:
+    """Counters for tuning the batch size / wait time trade-off."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.images = 0
+        self.batches = 0
+        self.max_batch_size = 0
+        self.queue_delay_total = 0.0
+        self.queue_delay_max = 0.0
+        self.inference_time_total = 0.0
+        self.phase_totals = {}
+
+    def record_batch(self, queue_delays, batch_size, timings):
+        """`timings` maps each phase (decode, preprocess, forward, postprocess) to seconds."""
+        with self._lock:
+            self.jobs += len(queue_delays)
+            self.images += batch_size
+            self.batches += 1
+            self.max_batch_size = max(self.max_batch_size, batch_size)
+            self.queue_delay_total += sum(queue_delays)
+            self.queue_delay_max = max([self.queue_delay_max, *queue_delays])
+            self.inference_time_total += sum(timings.values())
+            for phase, seconds in timings.items():
+                self.phase_totals[phase] = self.phase_totals.get(phase, 0.0) + seconds
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'jobs': self.jobs,
+                'batches': self.batches,
+                'avg_batch_size': self.images / self.batches if self.batches else 0,
+                'max_batch_size': self.max_batch_size,
+                'avg_queue_delay_ms': 1000 * self.queue_delay_total / self.jobs if self.jobs else 0,
+                'max_queue_delay_ms': 1000 * self.queue_delay_max,
+                'avg_batch_time_ms': 1000 * self.inference_time_total / self.batches if self.batches else 0,
+            }
+
+
+def _supervise(jobs, results, shutdown, workers, max_batch_size, max_wait, min_score, model_name, variant):
+    """Load the model once, fork the detection workers from here and replace any that die.
+
+    Runs in a spawned process that never starts a thread (it never puts on a
+    queue either), so forking from it is safe and the workers share the
+    weights copy-on-write. It stops once every web process has exited and
+    closed its end of `shutdown`.
+    """
+    if os.fork():
+        # detach, so the web processes never track the supervisor as their child: a forked gunicorn
+        # worker would otherwise terminate it through multiprocessing's atexit when it exits
+        return
+    # Ctrl-C reaches the whole process group, the pool stops with the web processes instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # exit through multiprocessing's atexit so the daemonic workers are terminated with us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    model_registry.model_name, model_registry.variant = model_name, variant
+    try:
+        model_registry.get()
+    except Exception:
+        # the workers retry on every batch and fail its jobs until it loads
+        logger.exception('Could not load the detection model')
+
+    ctx = mp.get_context('fork')
+    args = (jobs, results, max_batch_size, max_wait, min_score, max(1, (os.cpu_count() or 1) // workers))
+    processes = []
+    while True:
+        for i, process in enumerate(processes):
+            if not process.is_alive():
+                # a worker killed mid-batch (e.g. out of memory) takes its jobs with it, the sweep fails them
+                logger.warning('Detection worker %s exited with %s, restarting', process.pid, process.exitcode)
+                processes[i] = None
+        processes = [process for process in processes if process is not None]
+        while len(processes) < workers:
+            process = ctx.Process(target=_worker_main, args=args, daemon=True)
+            process.start()
+            processes.append(process)
+        if shutdown in mp_connection.wait([shutdown] + [process.sentinel for process in processes]):
+            return
+
+
+class DetectionPool:
+    """Bounded job queue feeding one pool of detection worker processes per host.
+
+    `start` runs in the gunicorn master (see gunicorn.conf.py), before any web
+    worker is forked, so every worker shares the same queue and processes;
+    without gunicorn the first upload starts them. A detached supervisor
+    loads the model once and forks the workers, which share it copy-on-write,
+    and stops with the last web process.
+
+    Uploads are queued with `submit` and answered right away; a collector
+    thread in each web process applies the verdicts it picks up. Each worker
+    coalesces up to `max_batch_size` queued images, waiting at most
+    `max_wait` seconds, into a single forward pass.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._shutdown = None
+        self._jobs = None
+        self._collector_pid = None
+        self.stats = DetectionStats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('DETECTION_WORKERS', 2)
+        self.queue_size = app.config.get('DETECTION_QUEUE_SIZE', 32)
+        self.max_batch_size = app.config.get('DETECTION_MAX_BATCH_SIZE', 8)
+        self.max_wait = app.config.get('DETECTION_MAX_WAIT_MS', 10) / 1000
+        self.min_score = min(app.config.get('AUDIT_MIN_SCORE', DETECTION_THRESHOLD), DETECTION_THRESHOLD)
+        self.job_timeout = app.config.get('DETECTION_JOB_TIMEOUT', 120)
+        app.extensions['detection'] = self
+
+    def start(self):
+        """Start the host's queues and detection processes, once."""
+        with self._lock:
+            if self._shutdown is not None:
+                return
+            # spawned rather than forked: a fresh interpreter inherits none of this process' threads or locks
+            ctx = mp.get_context('spawn')
+            self._jobs = ctx.Queue(maxsize=self.queue_size)
+            self._results = ctx.Queue()
+            # the web processes inherit the writing end, the supervisor sees EOF once they are all gone
+            reader, self._shutdown = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=_supervise, args=(
+                self._jobs, self._results, reader, self.workers, self.max_batch_size, self.max_wait, self.min_score,
+                model_registry.model_name, model_registry.variant))
+            # the spawned process only forks the supervisor and exits; keep gunicorn's SIGCHLD handler
+            # from reaping it before join does, which would leave it among our children
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD})
+            try:
+                process.start()
+                process.join()
+            finally:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+            reader.close()
+
+    def _ensure_started(self):
+        self.start()
+        with self._lock:
+            # one collector per web process, a forked gunicorn worker starts its own
+            if self._collector_pid != os.getpid():
+                self._collector_pid = os.getpid()
+                threading.Thread(target=self._collect, daemon=True).start()
+
+    def _collect(self):
+        swept = time.monotonic()
+        while True:
+            try:
+                verdicts, batch_size, timings = self._results.get(timeout=min(5, self.job_timeout))
+            except queue.Empty:
+                verdicts = None
+            if time.monotonic() - swept >= self.job_timeout:
+                swept = time.monotonic()
+                try:
+                    with self.app.app_context():
+                        expire_jobs(self.job_timeout)
+                except Exception:
+                    logger.exception('Could not expire stale detection jobs')
+            if verdicts is None:
+                continue
+            self.stats.record_batch([delay for *_, delay in verdicts], batch_size, timings)
+            batch_ms = 1000 * sum(timings.values())
+            for job_id, scores, error, delay in verdicts:
+                measurements = {'queue_ms': 1000 * delay, 'inference_ms': batch_ms, 'batch_size': batch_size}
+                try:
+                    with self.app.app_context():
+                        apply_verdict(job_id, above_threshold(scores) if scores is not None else None, error,
+                                      scores=scores, measurements=measurements)
+                except Exception:
+                    logger.exception('Could not apply verdict for detection job %s', job_id)
+
+    def submit(self, job, data):
+        """Queue a committed `DetectionJob` with the uploaded bytes, raising `queue.Full` when saturated."""
+        self._ensure_started()
+        self._jobs.put_nowait((job.id, data, time.time()))
+
+    def pending(self):
+        """Uploads waiting for a worker, across the host."""
+        return self._jobs.qsize() if self._jobs is not None else 0
+
+
+detection_pool = DetectionPool()
@@ -0,0 +1,75 @@
+from .models import db, Post, User
+from sqlalchemy.orm import joinedload, load_only
+from datetime import datetime
+import base64, json, uuid
+
+# sort option -> (keyset columns, descending); every key ends in Post.id so it is unique
+SORTS = {
+    'newest': ((Post.timestamp, Post.id), True),
+    'oldest': ((Post.timestamp, Post.id), False),
+    'most_karma': ((Post.score, Post.timestamp, Post.id), True),
+    'least_karma': ((Post.score, Post.timestamp, Post.id), False),
+}
+DEFAULT_SORT = 'newest'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(post, columns):
+    values = []
+    for column in columns:
+        value = getattr(post, column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, uuid.UUID):
+            value = str(value)
+        values.append(value)
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+# keyset column -> the JSON type its cursor value must have
+CURSOR_TYPES = {'timestamp': str, 'score': int, 'id': str}
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError as e:
+        raise InvalidCursor(cursor) from e
+    # a client can send any JSON, check every component before it reaches a parser or the query
+    if not isinstance(values, list) or len(values) != len(columns) or not all(
+            type(value) is CURSOR_TYPES[column.key] for column, value in zip(columns, values)):
+        raise InvalidCursor(cursor)
+    decoded = []
+    for column, value in zip(columns, values):
+        try:
+            if column.key == 'timestamp':
+                value = datetime.fromisoformat(value)
+            elif column.key == 'id':
+                value = uuid.UUID(value)
+        except ValueError as e:
+            raise InvalidCursor(cursor) from e
+        decoded.append(value)
+    return decoded
+
+def feed_page(sort_option, cursor=None, limit=24):
+    """Return one page of published posts and the cursor for the next one.
+
+    Each page is a range scan on the matching (status, ..., timestamp, id)
+    index, so the cost doesn't grow with the number of posts.
+    """
+    columns, descending = SORTS.get(sort_option, SORTS[DEFAULT_SORT])
+    # only the columns a post card and the cursor need, author joined in
+    query = Post.query.filter_by(status='published').options(
+        load_only(Post.id, Post.post_title, Post.image_url, Post.timestamp, Post.score, Post.user_id),
+        joinedload(Post.author).load_only(User.id, User.handle),
+    )
+    if cursor:
+        key = db.tuple_(*columns)
+        after = db.tuple_(*decode_cursor(cursor, columns))
+        query = query.filter(key < after if descending else key > after)
+    query = query.order_by(*(column.desc() if descending else column.asc() for column in columns))
+
+    posts = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(posts[limit - 1], columns) if len(posts) > limit else None
+    return posts[:limit], next_cursor
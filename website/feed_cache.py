@@ -0,0 +1,259 @@
+from flask import render_template
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, joinedload, load_only
+from collections import Counter, OrderedDict
+from .models import Post, User, Karma
+from .feed import SORTS, DEFAULT_SORT, feed_page
+from .renditions import renditions, UPLOADS_PREFIX
+import threading, time, json, logging
+
+logger = logging.getLogger(__name__)
+
+KARMA_SORTS = ('most_karma', 'least_karma')
+
+
+class LRUBackend:
+    """In-process LRU with a per-entry TTL. Each worker process has its own."""
+
+    def __init__(self, max_entries, ttl):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # kept apart from the entries so eviction can never roll a generation back
+        self._generations = Counter()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] < now:
+                    del self._entries[key]
+                    entry = None
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                values.append(entry[1] if entry is not None else None)
+        return values
+
+    def set_many(self, items):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in items.items():
+                self._entries[key] = (expires, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def generations(self, names):
+        with self._lock:
+            return [self._generations[name] for name in names]
+
+    def bump(self, names):
+        with self._lock:
+            for name in names:
+                self._generations[name] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Same interface on a (local) Redis, shared by every worker process.
+
+    Size based eviction is left to Redis' own `maxmemory-policy`.
+    """
+
+    prefix = 'tables:feed:'
+
+    def __init__(self, url, ttl):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.evictions = None
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [json.loads(raw) if raw is not None else None
+                for raw in self._client.mget([self.prefix + key for key in keys])]
+
+    def set_many(self, items):
+        pipe = self._client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+        pipe.execute()
+
+    def delete_many(self, keys):
+        if keys:
+            self._client.delete(*(self.prefix + key for key in keys))
+
+    def generations(self, names):
+        return [int(raw or 0) for raw in self._client.mget([f'{self.prefix}gen:{name}' for name in names])]
+
+    def bump(self, names):
+        pipe = self._client.pipeline(transaction=False)
+        for name in names:
+            pipe.incr(f'{self.prefix}gen:{name}')
+        pipe.execute()
+
+    def __len__(self):
+        return self._client.dbsize()
+
+
+class FeedCache:
+    """Caches feed pages (post ids per sort and cursor) and rendered post cards.
+
+    Page keys embed a generation per sort, and commits that touch `Post` or
+    `Karma` bump the generations of the sorts they can reorder, so stale pages
+    are simply never read again. Cards are dropped individually when their
+    post is edited or deleted. Comments don't appear in the feed, so they never
+    invalidate it. The cache is only on with a shared Redis, or with
+    FEED_CACHE_LOCAL for a single worker process.
+    """
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.hits = Counter()
+        self.misses = Counter()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        size = app.config.get('FEED_CACHE_SIZE', 2048)
+        ttl = app.config.get('FEED_CACHE_TTL', 60)
+        redis_url = app.config.get('FEED_CACHE_REDIS_URL')
+        if not size:
+            self.backend = None
+        elif redis_url:
+            self.backend = RedisBackend(redis_url, ttl)
+        elif app.config.get('FEED_CACHE_LOCAL', False):
+            self.backend = LRUBackend(size, ttl)
+        else:
+            # invalidation only reaches the process that committed, so an in-process cache
+            # would serve deleted posts (and miss published ones) in every other worker
+            self.backend = None
+        app.extensions['feed_cache'] = self
+
+        if not event.contains(Session, 'after_flush', _after_flush):
+            event.listen(Session, 'after_flush', _after_flush)
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+
+    def page(self, sort_option, cursor=None, limit=24):
+        """Return `(cards, next_cursor)` for one feed page, each card a dict with the rendered `html`."""
+        if self.backend is None:
+            posts, next_cursor = feed_page(sort_option, cursor, limit)
+            return [self._card(post) for post in posts], next_cursor
+
+        sort_option = sort_option if sort_option in SORTS else DEFAULT_SORT
+        [generation] = self.backend.generations([sort_option])
+        page_key = f'page:{sort_option}:{generation}:{limit}:{cursor or ""}'
+        [entry] = self.backend.get_many([page_key])
+        if entry is None:
+            self.misses['page'] += 1
+            posts, next_cursor = feed_page(sort_option, cursor, limit)
+            cards = [self._card(post) for post in posts]
+            self.backend.set_many({page_key: {'ids': [card['id'] for card in cards], 'next_cursor': next_cursor},
+                                   **{f'card:{card["id"]}': card for card in cards if self._complete(card)}})
+            return cards, next_cursor
+
+        self.hits['page'] += 1
+        cached = self.backend.get_many([f'card:{post_id}' for post_id in entry['ids']])
+        missing = [post_id for post_id, card in zip(entry['ids'], cached) if card is None]
+        self.hits['card'] += len(cached) - len(missing)
+        self.misses['card'] += len(missing)
+        if missing:
+            posts = Post.query.filter(Post.id.in_(missing)).options(
+                load_only(Post.id, Post.post_title, Post.image_url, Post.timestamp),
+                joinedload(Post.author).load_only(User.id, User.handle),
+            ).all()
+            rendered = {str(post.id): self._card(post) for post in posts}
+            self.backend.set_many({f'card:{post_id}': card for post_id, card in rendered.items() if self._complete(card)})
+            cached = [card or rendered.get(post_id) for post_id, card in zip(entry['ids'], cached)]
+        return [card for card in cached if card is not None], entry['next_cursor']
+
+    def _card(self, post):
+        return {
+            'id': str(post.id),
+            'post_title': post.post_title,
+            'image_url': post.image_url,
+            'handle': post.author.handle,
+            'timestamp': post.timestamp.isoformat(),
+            'html': render_template('_post_card.html', post=post),
+        }
+
+    def _complete(self, card):
+        # a card rendered before the upload writer finished has no srcset yet, don't keep that one
+        return not card['image_url'].startswith(UPLOADS_PREFIX) or renditions.srcset(card['image_url']) != ''
+
+    def invalidate(self, sorts=(), post_ids=()):
+        if self.backend is None:
+            return
+        if sorts:
+            self.backend.bump(sorted(sorts))
+        if post_ids:
+            self.backend.delete_many([f'card:{post_id}' for post_id in post_ids])
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__ if self.backend is not None else None,
+            'entries': len(self.backend) if self.backend is not None else 0,
+            'evictions': getattr(self.backend, 'evictions', None),
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+        }
+
+
+feed_cache = FeedCache()
+
+
+def _changed(obj, *attrs):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+def _after_flush(session, flush_context):
+    # collected per flush, applied only once the transaction commits
+    sorts, post_ids = session.info.setdefault('feed_cache_stale', (set(), set()))
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.status == 'published':
+            sorts.update(SORTS)
+        elif isinstance(obj, Karma) and obj.post_id is not None:
+            sorts.update(KARMA_SORTS)
+    for obj in session.dirty:
+        if isinstance(obj, Post):
+            if _changed(obj, 'status'):
+                sorts.update(SORTS)
+                post_ids.add(obj.id)
+            if _changed(obj, 'post_title', 'image_url'):
+                post_ids.add(obj.id)
+            if _changed(obj, 'score'):
+                sorts.update(KARMA_SORTS)
+        elif isinstance(obj, Karma) and obj.post_id is not None and _changed(obj, 'karma'):
+            sorts.update(KARMA_SORTS)
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            sorts.update(SORTS)
+            post_ids.add(obj.id)
+        elif isinstance(obj, Karma) and obj.post_id is not None:
+            sorts.update(KARMA_SORTS)
+
+def _after_commit(session):
+    sorts, post_ids = session.info.pop('feed_cache_stale', (set(), set()))
+    if sorts or post_ids:
+        try:
+            feed_cache.invalidate(sorts, post_ids)
+        except Exception:
+            logger.exception('Could not invalidate the feed cache')
+
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop('feed_cache_stale', None)
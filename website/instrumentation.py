@@ -0,0 +1,260 @@
+from flask import g, request, current_app, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+import threading, time, sys, os, logging
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """Counters and histograms rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        # callables yielding (name, labels, value) for values read at scrape time
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            buckets, total, count = self.histograms.get(key, ([0] * len(BUCKETS), 0.0, 0))
+            buckets = [n + (value <= bound) for n, bound in zip(buckets, BUCKETS)]
+            self.histograms[key] = (buckets, total + value, count + 1)
+
+    def render(self):
+        lines = []
+        def fmt(name, labels, value):
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            return f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}'
+
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(fmt(name, labels, value))
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            for bound, n in zip(BUCKETS, buckets):
+                lines.append(fmt(f'{name}_bucket', labels + (('le', bound),), n))
+            lines.append(fmt(f'{name}_bucket', labels + (('le', '+Inf'),), count))
+            lines.append(fmt(f'{name}_sum', labels, total))
+            lines.append(fmt(f'{name}_count', labels, count))
+        for fn in self.collectors:
+            for name, labels, value in fn():
+                if value is not None:
+                    lines.append(fmt(name, tuple(sorted(labels.items())), value))
+        return '\n'.join(lines) + '\n'
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            if has_request_context() and 'phases' in g:
+                g.phases['render'] = g.phases.get('render', 0.0) + time.perf_counter() - started
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of in-flight requests and dumps the slow ones.
+
+    Stacks are written in the folded format (`frame;frame;frame count`) that
+    flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, threshold, interval, directory):
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        self._active = {}
+        self._pid = None
+
+    def start(self):
+        if self._pid != os.getpid():
+            # one sampler thread per (forked) worker process
+            self._pid = os.getpid()
+            threading.Thread(target=self._sample, daemon=True).start()
+        self._active[threading.get_ident()] = Counter()
+
+    def stop(self, duration, name):
+        samples = self._active.pop(threading.get_ident(), None)
+        if not samples or duration < self.threshold:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{datetime.utcnow():%Y%m%dT%H%M%S%f}-{name}.folded')
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.info('Slow request %s took %.0fms, stacks written to %s', name, 1000 * duration, path)
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident, samples in list(self._active.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                if stack:
+                    samples[';'.join(reversed(stack))] += 1
+
+
+class Instrumentation:
+    """Opt-in per-request timings, SQL statement metrics and slow request profiles.
+
+    Enabled with INSTRUMENTATION=1. Timings are returned as `Server-Timing`
+    headers and aggregated for `/metrics` (admins only, see views.metrics);
+    each worker process reports its own.
+    """
+
+    def __init__(self, app=None):
+        self.metrics = Metrics()
+        self.enabled = False
+        self.profiler = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('INSTRUMENTATION', False)
+        app.extensions['instrumentation'] = self
+        if not self.enabled:
+            return
+
+        app.jinja_env.template_class = TimedTemplate
+        # listening on the Engine class covers every engine, replicas included
+        if not event.contains(Engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(Engine, 'handle_error', self._handle_error)
+        self.metrics.collectors = [self._pool_metrics, self._detection_metrics, self._feed_cache_metrics, self._audit_metrics,
+                                   self._startup_metrics]
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+        if app.config.get('PROFILE_SLOW_REQUESTS_MS'):
+            self.profiler = SlowRequestProfiler(app.config['PROFILE_SLOW_REQUESTS_MS'] / 1000,
+                                                app.config.get('PROFILE_SAMPLE_INTERVAL_MS', 5) / 1000,
+                                                app.config.get('PROFILE_DIR', 'profiles'))
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block of a request handler as its own Server-Timing phase."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled and has_request_context() and 'phases' in g:
+                g.phases[name] = g.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # keyed on the execution context, so a statement that fails can only lose its own start time
+        conn.info.setdefault('query_started', {})[id(context)] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop(id(context))
+        self.metrics.observe('tables_sql_statement_seconds', elapsed)
+        if has_request_context() and 'phases' in g:
+            g.phases['sql'] = g.phases.get('sql', 0.0) + elapsed
+            g.sql_statements += 1
+
+    def _handle_error(self, exception_context):
+        # a failed statement never reaches after_cursor_execute, don't let its start time pile up
+        conn = exception_context.connection
+        if conn is not None:
+            conn.info.get('query_started', {}).pop(id(exception_context.execution_context), None)
+
+    def _before_request(self):
+        g.request_started = time.perf_counter()
+        g.phases = {}
+        g.sql_statements = 0
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def _after_request(self, response):
+        duration = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or 'unknown'
+        if self.profiler is not None:
+            self.profiler.stop(duration, endpoint)
+
+        self.metrics.observe('tables_request_seconds', duration, endpoint=endpoint, method=request.method)
+        self.metrics.inc('tables_requests_total', endpoint=endpoint, status=response.status_code)
+        self.metrics.inc('tables_sql_statements_total', g.sql_statements, endpoint=endpoint)
+        for phase, seconds in g.phases.items():
+            self.metrics.observe('tables_request_phase_seconds', seconds, endpoint=endpoint, phase=phase)
+
+        timings = [f'{phase};dur={1000 * seconds:.2f}' for phase, seconds in g.phases.items()]
+        timings.append(f'sql_statements;desc="{g.sql_statements}"')
+        timings.append(f'total;dur={1000 * duration:.2f}')
+        response.headers.add('Server-Timing', ', '.join(timings))
+        return response
+
+    def _pool_metrics(self):
+        from .models import db
+
+        for key, engine in db.engines.items():
+            pool = engine.pool
+            if not isinstance(pool, QueuePool):
+                continue
+            labels = {'bind': key or 'default'}
+            capacity = pool.size() + current_app.config['DB_MAX_OVERFLOW']
+            yield 'tables_db_pool_checked_out', labels, pool.checkedout()
+            yield 'tables_db_pool_overflow', labels, max(pool.overflow(), 0)
+            yield 'tables_db_pool_saturation', labels, pool.checkedout() / capacity
+
+    def _detection_metrics(self):
+        from .detection import detection_pool, verdict_cache
+
+        stats = detection_pool.stats
+        yield 'tables_detection_jobs_total', {}, stats.jobs
+        yield 'tables_detection_batches_total', {}, stats.batches
+        yield 'tables_detection_batched_images_total', {}, stats.images
+        yield 'tables_detection_queue_delay_seconds_total', {}, stats.queue_delay_total
+        yield 'tables_detection_queue_depth', {}, detection_pool.pending()
+        for phase, seconds in sorted(stats.phase_totals.items()):
+            yield 'tables_detection_phase_seconds_total', {'phase': phase}, seconds
+        yield 'tables_verdict_cache_hits_total', {}, verdict_cache.hits
+        yield 'tables_verdict_cache_misses_total', {}, verdict_cache.misses
+
+    def _feed_cache_metrics(self):
+        from .feed_cache import feed_cache
+
+        stats = feed_cache.stats()
+        for kind in ('page', 'card'):
+            yield 'tables_feed_cache_hits_total', {'kind': kind}, stats['hits'].get(kind, 0)
+            yield 'tables_feed_cache_misses_total', {'kind': kind}, stats['misses'].get(kind, 0)
+        yield 'tables_feed_cache_entries', {}, stats['entries']
+        yield 'tables_feed_cache_evictions_total', {}, stats['evictions']
+
+    def _audit_metrics(self):
+        from .audit import audit_log
+
+        yield 'tables_detection_audit_buffered', {}, audit_log.pending()
+        yield 'tables_detection_audit_written_total', {}, audit_log.written
+        yield 'tables_detection_audit_dropped_total', {}, audit_log.dropped
+
+    def _startup_metrics(self):
+        for name, ms in current_app.extensions.get('startup_timings', {}).items():
+            yield f'tables_startup_{name[:-3]}_seconds', {}, ms / 1000 if ms is not None else None
+
+    def metrics_view(self):
+        return self.metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+instrumentation = Instrumentation()
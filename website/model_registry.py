@@ -0,0 +1,60 @@
+import threading, time, logging
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = ('default', 'quantized')
+
+
+class ModelRegistry:
+    """Loads the YOLOS model and processor once per process, on first use.
+
+    The detection supervisor calls `get` before forking its workers, so they
+    share one copy of the weights copy-on-write.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.model_name = 'hustvl/yolos-tiny'
+        self.variant = 'default'
+        self.model = None
+        self.image_processor = None
+        self.load_time = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.model_name = app.config.get('DETECTION_MODEL', self.model_name)
+        self.variant = app.config.get('DETECTION_MODEL_VARIANT', self.variant)
+        if self.variant not in VARIANTS:
+            raise ValueError(f'DETECTION_MODEL_VARIANT must be one of {", ".join(VARIANTS)}')
+        app.extensions['model_registry'] = self
+
+    @property
+    def key(self):
+        """Identifies the weights that produced a verdict, e.g. for the verdict cache."""
+        return self.model_name if self.variant == 'default' else f'{self.model_name}+{self.variant}'
+
+    def get(self):
+        if self.model is None:
+            with self._lock:
+                if self.model is None:
+                    self._load()
+        return self.model, self.image_processor
+
+    def _load(self):
+        started = time.perf_counter()
+        import torch
+        from transformers import YolosImageProcessor, YolosForObjectDetection
+
+        model = YolosForObjectDetection.from_pretrained(self.model_name)
+        model.eval()
+        if self.variant == 'quantized':
+            # int8 dynamic quantization of the Linear layers, CPU only
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.image_processor = YolosImageProcessor.from_pretrained(self.model_name)
+        self.model = model
+        self.load_time = time.perf_counter() - started
+        logger.info('Loaded %s in %.2fs', self.key, self.load_time)
+
+
+model_registry = ModelRegistry()
@@ -1,11 +1,30 @@
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.types import TypeDecorator, Uuid
 from flask_sqlalchemy import SQLAlchemy
-from flask import flash
 from flask_login import UserMixin
+from .database import RoutingSession
 from datetime import datetime
 import uuid
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+def trigram_installed(conn, *args, **kwargs):
+    # pg_trgm needs CREATE on the database, so `flask apply-cascades` installs it, never the app at boot
+    return conn is not None and conn.exec_driver_sql("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").first() is not None
+
+def search_document(column):
+    """The tsvector searched on Postgres; queries must build it exactly like the index does."""
+    return db.func.to_tsvector(db.literal_column("'english'"), db.func.coalesce(column, db.literal_column("''")))
+
+class UUID(TypeDecorator):
+    # native uuid on Postgres, CHAR(32) elsewhere (SQLite for benchmarks), and
+    # accepts the string ids that arrive through the routes
+    impl = Uuid
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return uuid.UUID(value)
+        return value
 
 class User(db.Model, UserMixin):
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -18,9 +37,20 @@ class User(db.Model, UserMixin):
     strikes = db.Column(db.Integer, default=0)
     pfp_url = db.Column(db.String(300), nullable=False, default='/static/user.svg')
     
-    posts = db.relationship('Post', backref='author', lazy=True, cascade="all, delete-orphan")
-    comments = db.relationship('Comment', backref='author', lazy=True, cascade="all, delete-orphan")
-    karma = db.relationship('Karma', backref='author', lazy=True, cascade="all, delete-orphan")
+    # the database cascades deletes (ON DELETE CASCADE), the ORM never loads the children to do it, see website/deletion.py
+    posts = db.relationship('Post', backref='author', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    comments = db.relationship('Comment', backref='author', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    karma = db.relationship('Karma', backref='author', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    detection_jobs = db.relationship('DetectionJob', backref='user', lazy=True, passive_deletes=True)
+    
+    # handle typeahead on Postgres: prefix matches and fuzzy (trigram) matches
+    __table_args__ = (
+        db.Index('ix_user_handle_prefix', db.func.lower(handle).label('handle_lower'),
+                 postgresql_ops={'handle_lower': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+        db.Index('ix_user_handle_trgm', db.func.lower(handle).label('handle_lower'),
+                 postgresql_using='gin', postgresql_ops={'handle_lower': 'gin_trgm_ops'})
+                 .ddl_if(dialect='postgresql', callable_=lambda ddl, target, conn, **kw: trigram_installed(conn)),
+    )
     
     def __init__(self, handle, name, email, password, description=None, signup_time=None):
         self.handle = handle
@@ -35,30 +65,50 @@ class Post(db.Model):
     post_title = db.Column(db.String(150), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     contains_chair = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), nullable=False, default='published')
+    score = db.Column(db.Integer, nullable=False, default=0)  # sum of Karma.karma, kept in step by the vote routes
+    
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    comments = db.relationship('Comment', backref='post', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    votes = db.relationship('Karma', backref='post', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    detection_jobs = db.relationship('DetectionJob', backref='post', lazy=True, passive_deletes=True)
     
-    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('user.id'), nullable=False)
-    comments = db.relationship('Comment', backref='post', lazy=True, cascade="all, delete-orphan")
+    # keyset pagination for the feed sorts, see website/feed.py
+    __table_args__ = (
+        db.Index('ix_post_status_timestamp_id', 'status', 'timestamp', 'id'),
+        db.Index('ix_post_status_score_timestamp_id', 'status', 'score', 'timestamp', 'id'),
+        db.Index('ix_post_title_search', search_document(post_title), postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
     
-    def __init__(self, image_url, user_id, post_title=None, timestamp=None, contains_chair=False):
+    def __init__(self, image_url, user_id, post_title=None, timestamp=None, contains_chair=False, status='published'):
         self.image_url = image_url
         self.user_id = user_id
         self.post_title = post_title
         if timestamp is not None:
             self.timestamp = timestamp
         self.contains_chair = contains_chair
+        self.status = status
+    
+    def publish(self, contains_chair):
+        self.status = 'published'
+        self.contains_chair = contains_chair
         
         if not contains_chair:
-            author = User.query.filter_by(id=user_id).first()
-            author.strikes += 1  # increment strikes for post author if contains chair
-            flash(f'You have {3 - author.strikes} strikes left.', category='error')
+            self.author.strikes += 1  # increment strikes for post author if missing chair
 
 class Comment(db.Model):
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     text = db.Column(db.String(300), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    score = db.Column(db.Integer, nullable=False, default=0)
     
-    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(UUID(as_uuid=True), db.ForeignKey('post.id'), nullable=False)
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    post_id = db.Column(UUID(as_uuid=True), db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False, index=True)
+    votes = db.relationship('Karma', backref='comment', lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    
+    __table_args__ = (
+        db.Index('ix_comment_text_search', search_document(text), postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
     
     def __init__(self, text, user_id, post_id, timestamp=None):
         self.text = text
@@ -68,12 +118,91 @@ class Comment(db.Model):
 class Karma(db.Model):
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     karma = db.Column(db.Integer, nullable=False, default=0)
-    object_uuid = db.Column(db.String, nullable=False)
-    object_type = db.Column(db.String, nullable=False)
-    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    # exactly one of these is set, depending on what was voted on
+    post_id = db.Column(UUID(as_uuid=True), db.ForeignKey('post.id', ondelete='CASCADE'), nullable=True, index=True)
+    comment_id = db.Column(UUID(as_uuid=True), db.ForeignKey('comment.id', ondelete='CASCADE'), nullable=True, index=True)
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='uq_karma_user_post'),
+        db.UniqueConstraint('user_id', 'comment_id', name='uq_karma_user_comment'),
+        db.CheckConstraint('(post_id IS NULL) != (comment_id IS NULL)', name='ck_karma_single_object'),
+    )
     
-    def __init__(self, karma, object_uuid, object_type, user_id):
+    def __init__(self, karma, user_id, post_id=None, comment_id=None):
         self.karma = karma
-        self.object_uuid = object_uuid
-        self.object_type = object_type
-        self.user_id = user_id
\ No newline at end of file
+        self.user_id = user_id
+        self.post_id = post_id
+        self.comment_id = comment_id
+
+class DetectionJob(db.Model):
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    kind = db.Column(db.String(10), nullable=False)  # 'post' or 'pfp'
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    image_url = db.Column(db.String(300), nullable=False)
+    message = db.Column(db.String(200), nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # set to NULL rather than cascaded so a banned user can still poll the verdict
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True, index=True)
+    post_id = db.Column(UUID(as_uuid=True), db.ForeignKey('post.id', ondelete='SET NULL'), nullable=True, index=True)
+    
+    __table_args__ = (
+        # the sweep for jobs past their deadline
+        db.Index('ix_detection_job_status_timestamp', 'status', 'timestamp'),
+    )
+    
+    def __init__(self, kind, image_url, user_id, post_id=None, content_hash=None):
+        self.kind = kind
+        self.image_url = image_url
+        self.user_id = user_id
+        self.post_id = post_id
+        self.content_hash = content_hash
+
+class DetectionCache(db.Model):
+    # keyed on the model and threshold too, so changing either invalidates old verdicts
+    content_hash = db.Column(db.String(64), primary_key=True)
+    model_name = db.Column(db.String(100), primary_key=True)
+    threshold = db.Column(db.Float, primary_key=True)
+    detections = db.Column(db.JSON, nullable=False)
+    contains_table = db.Column(db.Boolean, nullable=False)
+    contains_chair = db.Column(db.Boolean, nullable=False)
+    image_url = db.Column(db.String(300), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __init__(self, content_hash, model_name, threshold, detections, contains_table, contains_chair, image_url):
+        self.content_hash = content_hash
+        self.model_name = model_name
+        self.threshold = threshold
+        self.detections = detections
+        self.contains_table = contains_table
+        self.contains_chair = contains_chair
+        self.image_url = image_url
+
+class DetectionAudit(db.Model):
+    # one row per verdict, written in batches by website/audit.py; no foreign keys
+    # so the record outlives the user, post and job it is about
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    job_id = db.Column(UUID(as_uuid=True), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    user_id = db.Column(UUID(as_uuid=True), nullable=True)
+    post_id = db.Column(UUID(as_uuid=True), nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
+    verdict = db.Column(db.String(20), nullable=False)  # the job status it led to
+    error = db.Column(db.String(300), nullable=True)
+    cached = db.Column(db.Boolean, nullable=False)
+    model_name = db.Column(db.String(100), nullable=False)
+    threshold = db.Column(db.Float, nullable=False)
+    min_score = db.Column(db.Float, nullable=False)  # labels scoring below it were not recorded
+    queue_ms = db.Column(db.Float, nullable=True)
+    inference_ms = db.Column(db.Float, nullable=True)  # the whole batch
+    batch_size = db.Column(db.Integer, nullable=True)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+    
+    labels = db.relationship('DetectionAuditLabel', lazy=True, passive_deletes=True)
+
+class DetectionAuditLabel(db.Model):
+    audit_id = db.Column(UUID(as_uuid=True), db.ForeignKey('detection_audit.id', ondelete='CASCADE'), primary_key=True)
+    label = db.Column(db.String(50), primary_key=True, index=True)
+    score = db.Column(db.Float, nullable=False)
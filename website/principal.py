@@ -0,0 +1,106 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from collections import OrderedDict
+from .models import db, User
+import threading, time
+
+
+class Principal:
+    """What a request needs to know about the logged-in user, without the rest of the row."""
+
+    __slots__ = ('id', 'handle', 'pfp_url', 'strikes')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, handle, pfp_url, strikes):
+        self.id = id
+        self.handle = handle
+        self.pfp_url = pfp_url
+        self.strikes = strikes
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        return hasattr(other, 'get_id') and self.get_id() == other.get_id()
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class PrincipalCache:
+    """Short-lived per-process cache of `Principal`s for `load_user`.
+
+    Commits that change a user's handle, picture or strikes, or delete the
+    user, drop the entry in the committing process. Other worker processes
+    keep theirs until PRINCIPAL_CACHE_TTL runs out.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.ttl = 10
+        self.max_entries = 4096
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('PRINCIPAL_CACHE_TTL', self.ttl)
+        self.max_entries = app.config.get('PRINCIPAL_CACHE_SIZE', self.max_entries)
+        self.clear()
+        app.extensions['principal_cache'] = self
+
+        if not event.contains(Session, 'after_flush', _after_flush):
+            event.listen(Session, 'after_flush', _after_flush)
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+
+    def load(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        row = db.session.execute(db.select(User.id, User.handle, User.pfp_url, User.strikes)
+                                 .where(User.id == user_id)).first()
+        principal = Principal(*row) if row is not None else None
+        if principal is not None and self.ttl:
+            with self._lock:
+                self._entries[user_id] = (now + self.ttl, principal)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return principal
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+def _after_flush(session, flush_context):
+    stale = session.info.setdefault('stale_principals', set())
+    for obj in session.dirty:
+        if isinstance(obj, User) and any(db.inspect(obj).attrs[attr].history.has_changes()
+                                         for attr in Principal.__slots__):
+            stale.add(obj.id)
+    stale.update(obj.id for obj in session.deleted if isinstance(obj, User))
+
+def _after_commit(session):
+    stale = session.info.pop('stale_principals', None)
+    if stale:
+        principal_cache.invalidate(stale)
+
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop('stale_principals', None)
@@ -0,0 +1,129 @@
+from flask import url_for
+from PIL import Image, features
+from collections import OrderedDict
+import threading, hashlib, os, re, logging
+
+logger = logging.getLogger(__name__)
+
+UPLOADS_PREFIX = '/static/uploads/'
+SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+RENDITION_NAME = re.compile(r'^(?P<stem>[\w-]+)-(?P<width>\d+)w-(?P<digest>[0-9a-f]{12})\.(?P<ext>webp|jpg)$')
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+def render_rendition(source_path, target_path, width, fmt):
+    """Write a `width` pixel wide copy of `source_path`, never upscaling."""
+    image = Image.open(source_path)
+    image.draft('RGB', (width, width))
+    image = image.convert('RGBA' if fmt == 'WEBP' and image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    if image.width > width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    tmp_path = f'{target_path}.{os.getpid()}.tmp'
+    options = {'method': 4} if fmt == 'WEBP' else {'optimize': True}
+    image.save(tmp_path, fmt, quality=80, **options)
+    os.replace(tmp_path, target_path)
+
+def rendition_name(filename, width, digest, ext):
+    stem, _ = os.path.splitext(filename)
+    return f'{stem}-{width}w-{digest}.{ext}'
+
+def build_renditions(folder, filename, widths, fmt, digest=None):
+    """Write every missing rendition of `folder/filename`; returns how many were created.
+
+    A plain function so the backfill command can run it in a process pool.
+    """
+    source = os.path.join(folder, filename)
+    digest = digest or file_digest(source)
+    ext = 'webp' if fmt == 'WEBP' else 'jpg'
+    created = 0
+    for width in widths:
+        target = os.path.join(folder, rendition_name(filename, width, digest, ext))
+        if not os.path.exists(target):
+            render_rendition(source, target, width, fmt)
+            created += 1
+    return created
+
+
+class RenditionService:
+    """Fixed-width, content-hashed renditions of uploaded images for `srcset`.
+
+    Names look like `<source stem>-<width>w-<digest>.webp`, where the digest is
+    taken from the source bytes, so they can be cached forever. Renditions are
+    written at upload time and otherwise created on first request.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._digests = OrderedDict()
+        self.widths = (320, 640, 1280)
+        self.cache_size = 4096
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # absolute, since send_from_directory resolves relative paths against the package
+        self.folder = os.path.abspath(app.config['UPLOAD_FOLDER']) if app.config['UPLOAD_FOLDER'] else None
+        self.widths = tuple(app.config.get('RENDITION_WIDTHS', self.widths))
+        self.format = 'WEBP' if features.check('webp') else 'JPEG'
+        self.ext = 'webp' if self.format == 'WEBP' else 'jpg'
+        app.jinja_env.globals['srcset'] = self.srcset
+        app.extensions['renditions'] = self
+
+    def _source_digest(self, filename):
+        with self._lock:
+            if filename in self._digests:
+                self._digests.move_to_end(filename)
+                return self._digests[filename]
+        path = os.path.join(self.folder, filename)
+        if not os.path.exists(path):
+            return None  # still being written
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[filename] = digest
+            while len(self._digests) > self.cache_size:
+                self._digests.popitem(last=False)
+        return digest
+
+    def rendition_name(self, filename, width, digest):
+        return rendition_name(filename, width, digest, self.ext)
+
+    def srcset(self, image_url):
+        """`srcset` value for an uploaded image, empty for anything else (e.g. the default avatar)."""
+        if not image_url or not image_url.startswith(UPLOADS_PREFIX):
+            return ''
+        filename = image_url[len(UPLOADS_PREFIX):]
+        digest = self._source_digest(filename)
+        if digest is None:
+            return ''
+        return ', '.join(f"{url_for('views.rendition', filename=self.rendition_name(filename, width, digest))} {width}w"
+                         for width in self.widths)
+
+    def generate(self, filename):
+        """Write every missing rendition of an uploaded file; returns how many were created."""
+        digest = self._source_digest(filename)
+        if digest is None:
+            return 0
+        return build_renditions(self.folder, filename, self.widths, self.format, digest)
+
+    def resolve(self, name):
+        """Path of the rendition called `name`, created on demand; None when it isn't a valid rendition."""
+        match = RENDITION_NAME.match(name)
+        if match is None or int(match['width']) not in self.widths or match['ext'] != self.ext:
+            return None
+        path = os.path.join(self.folder, name)
+        if os.path.exists(path):
+            return path
+        for ext in SOURCE_EXTENSIONS:
+            source = match['stem'] + ext
+            if self._source_digest(source) == match['digest']:
+                render_rendition(os.path.join(self.folder, source), path, int(match['width']), self.format)
+                return path
+        return None
+
+
+renditions = RenditionService()
@@ -0,0 +1,80 @@
+from .detection import detect_batch, above_threshold, classify, model_input_edge
+from .model_registry import model_registry
+from .uploads import open_reduced
+import json, os, time
+
+
+def init_worker(threads):
+    # the workers share the cores, keep torch from starting a thread per core in each
+    import torch
+    torch.set_num_threads(threads)
+
+def scan_images(folder, items):
+    """Run detection over `[(key, filename)]` as one batch; returns `[(key, detection_dict or None, error)]`."""
+    _, image_processor = model_registry.get()
+    edge = model_input_edge(image_processor)
+    results, images, loaded = [], [], []
+    for key, filename in items:
+        try:
+            with open(os.path.join(folder, filename), 'rb') as f:
+                images.append(open_reduced(f.read(), edge))
+            loaded.append(key)
+        except Exception as e:
+            results.append((key, None, repr(e)))
+    if images:
+        try:
+            results.extend((key, above_threshold(scores), None) for key, scores in zip(loaded, detect_batch(images)))
+        except Exception as e:
+            results.extend((key, None, repr(e)) for key in loaded)
+    return results
+
+def post_changes(row, detection_dict):
+    """The columns of a `(id, status, contains_chair)` post row a new verdict changes, or None."""
+    post_id, status, contains_chair = row
+    contains_table, new_contains_chair = classify(detection_dict)
+    # a table hides the post for review rather than banning anyone after the fact
+    new_status = 'flagged' if contains_table else 'published' if status == 'flagged' else status
+    if (new_status, new_contains_chair) == (status, contains_chair):
+        return None
+    return {'id': post_id, 'status': new_status, 'contains_chair': new_contains_chair}
+
+
+class Checkpoint:
+    """Last id scanned per table, saved after every committed chunk so a rescan can resume."""
+
+    def __init__(self, path, model_name, threshold):
+        self.path = path
+        self.state = {'model': model_name, 'threshold': threshold, 'last': {}, 'scanned': 0, 'changed': 0}
+
+    def load(self):
+        """Resume from the file; False when it was written for another model or threshold."""
+        if not os.path.exists(self.path):
+            return True
+        with open(self.path) as f:
+            state = json.load(f)
+        if (state['model'], state['threshold']) != (self.state['model'], self.state['threshold']):
+            return False
+        self.state = state
+        return True
+
+    def save(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+
+class RateLimiter:
+    """Spaces out calls so no more than `rate` items per second go through; 0 means unlimited."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.monotonic()
+
+    def wait(self, items):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next > now:
+            time.sleep(self.next - now)
+        self.next = max(self.next, now) + items * self.interval
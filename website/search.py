@@ -0,0 +1,90 @@
+from .models import db, User, Post, Comment, search_document, trigram_installed
+from sqlalchemy import or_, and_
+
+KINDS = ('posts', 'comments', 'users')
+MAX_PAGES = 20
+MAX_QUERY_LENGTH = 100
+
+
+class InvalidSearch(ValueError):
+    pass
+
+
+# engine -> whether pg_trgm is installed there
+_trigram = {}
+
+
+def _is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+def _has_trigram():
+    engine = db.session.get_bind()
+    if engine not in _trigram:
+        with engine.connect() as conn:
+            _trigram[engine] = trigram_installed(conn)
+    return _trigram[engine]
+
+def _text_match(column, q):
+    """`(where clause, rank)` for a full-text query on `column`.
+
+    On Postgres this is a tsquery against the GIN index on `search_document`
+    ranked with ts_rank_cd; elsewhere (SQLite test runs) every word has to
+    appear in the text and results are not ranked.
+    """
+    if _is_postgres():
+        query = db.func.websearch_to_tsquery(db.literal_column("'english'"), q)
+        document = search_document(column)
+        return document.op('@@')(query), db.func.ts_rank_cd(document, query)
+    words = q.replace('"', ' ').split()
+    return and_(db.true(), *[column.icontains(word, autoescape=True) for word in words]), db.literal(0.0)
+
+def search_posts(q):
+    where, rank = _text_match(Post.post_title, q)
+    return db.select(Post.id, Post.post_title, Post.image_url, Post.timestamp, User.handle, rank.label('rank'))\
+        .join(User, User.id == Post.user_id)\
+        .where(where, Post.status == 'published')\
+        .order_by(rank.desc(), Post.timestamp.desc(), Post.id.desc())
+
+def search_comments(q):
+    where, rank = _text_match(Comment.text, q)
+    return db.select(Comment.id, Comment.text, Comment.post_id, Comment.timestamp, User.handle, rank.label('rank'))\
+        .join(User, User.id == Comment.user_id)\
+        .join(Post, Post.id == Comment.post_id)\
+        .where(where, Post.status == 'published')\
+        .order_by(rank.desc(), Comment.timestamp.desc(), Comment.id.desc())
+
+def search_users(q):
+    # typeahead: prefix matches first, then handles that merely look alike
+    handle = db.func.lower(User.handle)
+    prefix = handle.startswith(q.lower(), autoescape=True)
+    if _is_postgres() and _has_trigram():
+        similar = handle.op('%')(q.lower())
+        closeness = db.func.similarity(handle, q.lower())
+    else:
+        similar = handle.contains(q.lower(), autoescape=True)
+        closeness = -db.func.length(User.handle)
+    return db.select(User.handle, User.name, User.pfp_url)\
+        .where(or_(prefix, similar))\
+        .order_by(db.case((prefix, 0), else_=1), closeness.desc(), User.handle)
+
+SEARCHES = {'posts': search_posts, 'comments': search_comments, 'users': search_users}
+
+def search(kind, q, page=1, limit=20):
+    """Return one page of results as dicts and the number of the next page, or None."""
+    q = (q or '').strip()
+    if kind not in KINDS or len(q) > MAX_QUERY_LENGTH or not 1 <= page <= MAX_PAGES:
+        raise InvalidSearch(kind, q, page)
+    if not q:
+        return [], None
+
+    rows = db.session.execute(SEARCHES[kind](q).offset((page - 1) * limit).limit(limit + 1)).mappings().all()
+    results = []
+    for row in rows[:limit]:
+        result = dict(row)
+        for key, value in result.items():
+            if key.endswith('id') and value is not None:
+                result[key] = str(value)
+            elif key == 'timestamp':
+                result[key] = value.isoformat()
+        results.append(result)
+    return results, page + 1 if len(rows) > limit and page < MAX_PAGES else None
@@ -0,0 +1,100 @@
+from flask import Request
+from PIL import Image
+from .renditions import renditions
+from concurrent.futures import ThreadPoolExecutor
+import threading, hashlib, io, os, math, logging
+
+logger = logging.getLogger(__name__)
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class UploadRequest(Request):
+    # keep multipart files in memory instead of spooling them to a temp file;
+    # MAX_CONTENT_LENGTH already bounds how much that can be
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
+def read_upload(file, max_bytes):
+    """Return an uploaded file's bytes and their sha256 as `(data, sha256)`."""
+    if isinstance(file.stream, io.BytesIO):
+        # the buffer UploadRequest parsed the upload into; getvalue hands over that very
+        # buffer rather than a copy, so the upload is held in memory exactly once
+        data = file.stream.getvalue()
+    else:
+        data = file.stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise UploadTooLarge(file.filename)
+    return data, hashlib.sha256(data).hexdigest()
+
+def open_reduced(data, shortest_edge):
+    """Decode image bytes as RGB with the shortest edge scaled down to `shortest_edge`.
+
+    JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale via draft mode, so a
+    large photo is never expanded to full resolution in memory.
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    scale = shortest_edge / min(width, height)
+    if scale >= 1:
+        return image.convert('RGB')
+
+    size = (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)))
+    image.draft('RGB', size)
+    image = image.convert('RGB')
+    if image.size != size:
+        image = image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return image
+
+
+class UploadWriter:
+    """Writes stored uploads, their web-size copy and its `srcset` renditions off the request thread."""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.folder = app.config['UPLOAD_FOLDER']
+        self.web_edge = app.config.get('UPLOAD_WEB_EDGE', 1600)
+        self.workers = app.config.get('UPLOAD_WRITERS', 2)
+        app.extensions['upload_writer'] = self
+
+    def web_filename(self, filename):
+        name, ext = os.path.splitext(filename)
+        return f'{name}-web{ext}'
+
+    def submit(self, data, filename):
+        """Schedule `data` to be written as `filename` plus its web rendition."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # threads don't survive a fork, start a fresh executor in each worker
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='upload-writer')
+        return self._executor.submit(self._write, data, filename)
+
+    def _write(self, data, filename):
+        try:
+            with open(os.path.join(self.folder, filename), 'wb') as f:
+                f.write(data)
+
+            image = Image.open(io.BytesIO(data))
+            image.draft(image.mode, (self.web_edge, self.web_edge))
+            image.thumbnail((self.web_edge, self.web_edge), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            jpeg = os.path.splitext(filename)[1].lower() in ('.jpg', '.jpeg')
+            if image.mode == 'CMYK' or jpeg and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(os.path.join(self.folder, self.web_filename(filename)), quality=85, optimize=True)
+            renditions.generate(self.web_filename(filename))
+        except Exception:
+            logger.exception('Could not store upload %s', filename)
+            raise
+
+
+upload_writer = UploadWriter()
@@ -1,14 +1,23 @@
-from flask import Blueprint, render_template, request, url_for, redirect, flash, current_app, jsonify, abort
+from flask import Blueprint, render_template, request, url_for, redirect, flash, current_app, jsonify, abort, send_from_directory
 from flask_login import login_required, current_user
-from sqlalchemy import cast, String, UUID
-from .models import db, User, Post, Karma, Comment
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload, load_only
+from .models import db, User, Post, Karma, Comment, DetectionJob
+from .detection import detection_pool, verdict_cache, apply_verdict, expire_jobs
+from .uploads import upload_writer, read_upload, UploadTooLarge
+from .renditions import renditions
+from .model_registry import model_registry
+from .feed import InvalidCursor
+from .feed_cache import feed_cache
+from .search import search, InvalidSearch
+from .deletion import deletion
+from .audit import audit_log
+from .instrumentation import instrumentation
+from .database import use_replica
 from werkzeug.utils import secure_filename
-import uuid, os, math
-
-from transformers import YolosImageProcessor, YolosForObjectDetection
-import torch
-from PIL import Image
-import asyncio
+from datetime import datetime, timedelta
+from functools import wraps
+import uuid, os, math, queue
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
@@ -25,43 +34,57 @@ def banned(reason):
 
 @views.get('/feed')
 @login_required
+@use_replica
 def feed():
     sort_option = request.args.get('sort', 'select')
-    if sort_option == 'oldest':
-        posts = Post.query.order_by(Post.timestamp.asc()).all()
-    elif sort_option == 'newest':
-        posts = Post.query.order_by(Post.timestamp.desc()).all()
-    elif sort_option == 'most_karma':
-        posts_with_karma = db.session.query(Post).join(Karma, Post.id == cast(Karma.object_uuid, UUID))\
-        .filter(Karma.object_type == 'post')\
-        .order_by(Karma.karma.desc(), Post.timestamp.desc()).all()
-
-        posts_without_karma = db.session.query(Post).outerjoin(Karma, Post.id == cast(Karma.object_uuid, UUID))\
-            .filter(Karma.object_type == None)\
-            .order_by(Post.timestamp.desc()).all()
-
-        posts = posts_with_karma + posts_without_karma
-    elif sort_option == 'least_karma':
-        posts_with_karma = db.session.query(Post).join(Karma, Post.id == cast(Karma.object_uuid, UUID))\
-            .filter(Karma.object_type == 'post')\
-            .order_by(Karma.karma.asc(), Post.timestamp.asc()).all()
-
-        posts_without_karma = db.session.query(Post).outerjoin(Karma, Post.id == cast(Karma.object_uuid, UUID))\
-            .filter(Karma.object_type == None)\
-            .order_by(Post.timestamp.asc()).all()
-
-        posts = posts_with_karma + posts_without_karma
-    else:
-        posts = Post.query.order_by(Post.timestamp.desc()).all()
-    num_posts = Post.query.count()
-    column_size = math.ceil(num_posts / 3)
-    return render_template('Feed.html', user=current_user, posts=posts, num_posts=num_posts, column_size=column_size)
+    cards, next_cursor = feed_cache.page(sort_option, limit=current_app.config['FEED_PAGE_SIZE'])
+    return render_template('Feed.html', user=current_user, cards=cards, sort_option=sort_option, next_cursor=next_cursor)
+
+@views.get('/feed/page')
+@login_required
+@use_replica
+def feed_next_page():
+    sort_option = request.args.get('sort', 'select')
+    try:
+        cards, next_cursor = feed_cache.page(sort_option, request.args.get('cursor'), limit=current_app.config['FEED_PAGE_SIZE'])
+    except InvalidCursor:
+        abort(400)
+    return jsonify(next_cursor=next_cursor, posts=cards)
+
+@views.get('/feed/stats')
+@login_required
+def feed_cache_stats():
+    return jsonify(feed_cache.stats())
+
+@views.get('/search')
+@login_required
+@use_replica
+def search_view():
+    try:
+        results, next_page = search(request.args.get('type', 'posts'), request.args.get('q'),
+                                    request.args.get('page', 1, type=int), limit=current_app.config['SEARCH_PAGE_SIZE'])
+    except InvalidSearch:
+        abort(400)
+    return jsonify(results=results, next_page=next_page)
+
+@views.get('/renditions/<string:filename>')
+def rendition(filename):
+    if renditions.resolve(filename) is None:
+        abort(404)
+    # names carry a digest of the source, so they never change underneath a client
+    response = send_from_directory(renditions.folder, filename, max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @views.get('/profile/<string:handle>')
 @login_required
+@use_replica
 def profile(handle):
     profile = User.query.filter_by(handle=handle).first()
-    user_posts = profile.posts
+    user_posts = Post.query.filter_by(user_id=profile.id, status='published')\
+        .options(load_only(Post.id, Post.post_title, Post.image_url, Post.timestamp))\
+        .order_by(Post.timestamp.desc()).all()
     num_posts = len(user_posts)
     column_size = math.ceil(num_posts / 3)
     return render_template('Profile.html', profile=profile, user=current_user, num_posts=num_posts, column_size=column_size, user_posts=user_posts)
@@ -71,25 +94,50 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-model = YolosForObjectDetection.from_pretrained('hustvl/yolos-tiny')
-image_processor = YolosImageProcessor.from_pretrained("hustvl/yolos-tiny")
-
-async def run_object_detection(image_path):
-    image = Image.open(image_path).convert('RGB')
-    inputs = image_processor(images=image, return_tensors="pt")
-    outputs = model(**inputs)
-
-    # convert outputs (bounding boxes and class logits) to COCO API
-    target_sizes = torch.tensor([image.size[::-1]])
-    results = image_processor.post_process_object_detection(outputs, threshold=0.5, target_sizes=target_sizes)[0]
-        
-    detection_dict = {}
-    for score, label, box in zip(results["scores"], results["labels"], results["boxes"]):
-        label_name = model.config.id2label[label.item()]
-        confidence = round(score.item(), 3)
-        detection_dict[label_name] = confidence
-    
-    return detection_dict
+def store_upload(file, cached):
+    """Pick the stored filename and url for an upload; `None` filename means nothing to write."""
+    if cached is not None:
+        # identical bytes are already stored, point at that file instead of writing a copy
+        image_url = cached[1]
+        if os.path.exists(os.path.join(current_app.config['UPLOAD_FOLDER'], os.path.basename(image_url))):
+            return None, image_url
+
+    filename = secure_filename(file.filename)
+    _, ext = os.path.splitext(filename)
+    new_filename = f"{uuid.uuid4().hex}{ext.lower()}"  # Generate a unique filename
+    return new_filename, url_for('static', filename=f'uploads/{upload_writer.web_filename(new_filename)}')
+
+def start_detection(job, data, filename, cached):
+    if cached is not None:
+        if filename is not None:
+            # the cached file was gone and this upload is being stored again, point the cache at the new copy
+            verdict_cache.put(job.content_hash, cached[0], job.image_url)
+        apply_verdict(job.id, cached[0], cached=True)
+    else:
+        try:
+            detection_pool.submit(job, data)
+        except queue.Full:
+            if job.post is not None:
+                db.session.delete(job.post)
+            db.session.delete(job)
+            db.session.commit()
+            flash('Too many uploads are being checked right now, please try again shortly.', category='error')
+            return False
+    if filename is not None:
+        upload_writer.submit(data, filename)
+    return True
+
+def read_image_upload(file):
+    try:
+        return read_upload(file, current_app.config['UPLOAD_MAX_BYTES'])
+    except UploadTooLarge:
+        flash(f'Images must be smaller than {current_app.config["UPLOAD_MAX_BYTES"] // 2**20} MB.', category='error')
+        return None, None
+
+@views.app_errorhandler(413)
+def upload_too_large(error):
+    flash(f'Images must be smaller than {current_app.config["UPLOAD_MAX_BYTES"] // 2**20} MB.', category='error')
+    return redirect(request.url)
 
 @views.route('/new-post', methods=['GET', 'POST'])
 @login_required
@@ -102,44 +150,29 @@ def new_post():
         if file.filename == '':
             flash('No selected file', category='error')
             return redirect(request.url)
+        post_title = request.form.get('title')
+        if not post_title:
+            flash('Title is required!', category='error')
+            return redirect(request.url)
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            _, ext = os.path.splitext(filename)
-            new_filename = f"{uuid.uuid4().hex}{ext}"  # Generate a unique filename
-            file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], new_filename))
-            image_url = url_for('static', filename=f'uploads/{new_filename}')
-
-            # Run object detection asynchronously in the background
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            detection_dict = loop.run_until_complete(run_object_detection(os.path.join(current_app.config['UPLOAD_FOLDER'], new_filename)))
-
-            contains_table = any("table" in label or "bench" in label for label in detection_dict.keys())
-            contains_chair = 1 if not detection_dict or any("chair" in label for label in detection_dict.keys()) else 0
-            
-            if contains_table:
-                # Delete the user who posted the table
-                db.session.delete(current_user)
-                db.session.commit()
-                flash(f'Illegal Table Post!', category='error')
-                return redirect(url_for('views.banned', reason='table'))
-            
-            post_title = request.form.get('title')
-            if not post_title:
-                flash('Title is required!', category='error')
-                return redirect(request.url)
-            
-            if current_user.strikes >= 2:
-                flash('Your account has been deleted due to three strikes!', category='error')
-                db.session.delete(current_user)
-                db.session.commit()
-                return redirect(url_for('views.banned', reason='strike'))
-            
-            post = Post(image_url=image_url, user_id=current_user.id, post_title=post_title, contains_chair=contains_chair)
+            with instrumentation.phase('upload'):
+                data, content_hash = read_image_upload(file)
+                if data is None:
+                    return redirect(request.url)
+                cached = verdict_cache.get(content_hash)
+                filename, image_url = store_upload(file, cached)
+
+            # Held back from the feed until the detection pool returns a verdict
+            post = Post(image_url=image_url, user_id=current_user.id, post_title=post_title, status='pending')
             db.session.add(post)
+            db.session.flush()
+            job = DetectionJob(kind='post', image_url=image_url, user_id=current_user.id, post_id=post.id, content_hash=content_hash)
+            db.session.add(job)
             db.session.commit()
-            flash('Your post has been created!', category='success')
-            return redirect(url_for('views.feed'))
+
+            if not start_detection(job, data, filename, cached):
+                return redirect(request.url)
+            return redirect(url_for('views.detection_pending', job_id=job.id))
         else:
             flash('Allowed file types are png, jpg, jpeg.', category='error')
             return redirect(request.url)
@@ -147,68 +180,142 @@ def new_post():
     return render_template('New.html', user=current_user)
 
 
+@views.get('/detection/stats')
+@login_required
+def detection_stats():
+    return jsonify(pending=detection_pool.pending(), cache_hits=verdict_cache.hits, cache_misses=verdict_cache.misses,
+                   model=model_registry.key, startup=current_app.extensions['startup_timings'],
+                   **detection_pool.stats.as_dict())
+
+def admin_required(view):
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if current_user.handle not in current_app.config['ADMIN_HANDLES']:
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+@views.get('/metrics')
+@admin_required
+def metrics():
+    # pool, route and SQL timings are not for everyone to read
+    if not instrumentation.enabled:
+        abort(404)
+    return instrumentation.metrics_view()
+
+@views.get('/admin/detection-report')
+@admin_required
+def detection_report():
+    days = request.args.get('days', 7, type=float)
+    since = datetime.utcnow() - timedelta(days=days) if days > 0 else None
+    report = audit_log.report(since=since, model_name=request.args.get('model'))
+    return jsonify(days=days, model=request.args.get('model'), buffered=audit_log.pending(), **report)
+
+@views.get('/detection/<string:job_id>')
+def detection_pending(job_id):
+    job = DetectionJob.query.filter_by(id=job_id).first_or_404()
+    return render_template('Pending.html', user=current_user, job=job)
+
+@views.get('/detection/<string:job_id>/status')
+def detection_status(job_id):
+    job = DetectionJob.query.filter_by(id=job_id).first_or_404()
+    if job.user_id is not None and (not current_user.is_authenticated or job.user_id != current_user.id):
+        abort(404)
+    if job.status == 'pending':
+        # the sweep only runs in processes with a live pool, a job queued before a restart is failed here
+        expire_jobs(detection_pool.job_timeout, job.id)
+
+    redirect_url = None
+    if job.status == 'published':
+        if job.kind == 'post':
+            flash('Your post has been created!', category='success')
+            redirect_url = url_for('views.feed')
+        else:
+            flash('Your profile picture has been updated!', category='success')
+            redirect_url = url_for('views.profile', handle=current_user.handle)
+    elif job.status == 'rejected_table':
+        if job.kind == 'post':
+            flash('Illegal Table Post!', category='error')
+        else:
+            flash('Illegal Profile Picture! Your account has been deleted.', category='error')
+        redirect_url = url_for('views.banned', reason='table')
+    elif job.status == 'rejected_strike':
+        flash('Your account has been deleted due to three strikes!', category='error')
+        redirect_url = url_for('views.banned', reason='strike')
+    elif job.status == 'failed':
+        if job.user_id is None:
+            # the account was deleted (e.g. banned by another upload) while this one waited
+            redirect_url = url_for('views.landing')
+        elif job.kind == 'post':
+            redirect_url = url_for('views.new_post')
+        else:
+            redirect_url = url_for('views.edit_profile_picture', user_id=job.user_id)
+    if job.message and redirect_url is not None:
+        flash(job.message, category='error')
+
+    return jsonify(status=job.status, redirect=redirect_url)
+
+
 @views.get('/post/<string:post_id>')
 @login_required
+@use_replica
 def get_post_by_id(post_id):
-    post = Post.query.filter_by(id=post_id).first()
-    post_karma = db.session.query(db.func.sum(Karma.karma)).filter_by(object_uuid=post_id).scalar()
-    if post_karma is None: post_karma = 0
-    comment_karma = {}
-    for comment in post.comments:
-        comment_karma[comment.id] = db.session.query(db.func.sum(Karma.karma)).filter_by(object_uuid=str(comment.id)).scalar()
-        if comment_karma[comment.id] is None:
-            comment_karma[comment.id] = 0
-    return render_template('Post.html', post=post, user=current_user, post_karma=post_karma, comment_karma=comment_karma)
-
+    post = Post.query.filter_by(id=post_id).options(
+        joinedload(Post.author).load_only(User.id, User.handle),
+        selectinload(Post.comments).joinedload(Comment.author).load_only(User.id, User.handle),
+    ).first()
+    # pending and flagged posts are only visible to their author
+    if post is None or (post.status != 'published' and post.user_id != current_user.id):
+        abort(404)
+    return render_template('Post.html', post=post, user=current_user)
+
+
+def toggle_karma(object_uuid, value, retry=True):
+    """Cast, flip or clear the current user's vote and return the post it lands on.
+
+    The vote row and the denormalized `score` change in the same transaction.
+    """
+    post = Post.query.filter_by(id=object_uuid).first()
+    if post is not None:
+        target, vote_filter, post_id = Post, {'post_id': post.id}, post.id
+    else:
+        comment = Comment.query.filter_by(id=object_uuid).first_or_404()
+        target, vote_filter, post_id = Comment, {'comment_id': comment.id}, comment.post_id
+
+    try:
+        karma = Karma.query.filter_by(user_id=current_user.id, **vote_filter).with_for_update().first()
+        if karma is None:
+            karma = Karma(karma=value, user_id=current_user.id, **vote_filter)
+            db.session.add(karma)
+            db.session.flush()
+            delta = value
+        else:
+            new_value = 0 if karma.karma == value else value
+            delta = new_value - karma.karma
+            karma.karma = new_value
+        if delta:
+            target.query.filter_by(id=object_uuid).update({target.score: target.score + delta}, synchronize_session=False)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if not retry:
+            abort(409)
+        # a concurrent request cast the first vote, toggle against that row instead
+        return toggle_karma(object_uuid, value, retry=False)
+    return post_id
 
 @views.get('/karma/upvote-karma/<string:user_id>/<string:object_uuid>')
 @login_required
 def upvote_karma(object_uuid, user_id):
-    karma = Karma.query.filter_by(object_uuid=object_uuid, user_id=user_id).first()
-    if karma is None:
-        if Post.query.filter_by(id=object_uuid).first():
-            karma = Karma(karma=1, object_uuid=object_uuid, object_type='post', user_id=current_user.id)
-        else:
-            comment = Comment.query.filter_by(id=object_uuid).first()
-            karma = Karma(karma=1, object_uuid=object_uuid, object_type='comment', user_id=current_user.id)
-        db.session.add(karma)
-    elif karma.karma == 1 and karma.user_id == current_user.id:
-        karma.karma = 0
-        db.session.commit()
-    else:
-        karma.karma = 1
-    db.session.commit()
-    
-    if karma.object_type == 'post':
-        return redirect(url_for('views.get_post_by_id', post_id=karma.object_uuid))
-    else:
-        comment = Comment.query.filter_by(id=karma.object_uuid).first()
-        return redirect(url_for('views.get_post_by_id', post_id=comment.post_id))
+    post_id = toggle_karma(object_uuid, 1)
+    return redirect(url_for('views.get_post_by_id', post_id=post_id))
 
-        
 @views.get('/karma/downvote-karma/<string:user_id>/<string:object_uuid>')
 @login_required
 def downvote_karma(object_uuid, user_id):
-    karma = Karma.query.filter_by(object_uuid=object_uuid, user_id=user_id).first()
-    if karma is None:
-        if Post.query.filter_by(id=object_uuid).first():
-            karma = Karma(karma=-1, object_uuid=object_uuid, object_type='post', user_id=current_user.id)
-        else:
-            comment = Comment.query.filter_by(id=object_uuid).first()
-            karma = Karma(karma=-1, object_uuid=object_uuid, object_type='comment', user_id=current_user.id)
-        db.session.add(karma)
-    elif karma.karma == -1 and karma.user_id == current_user.id:
-        karma.karma = 0
-        db.session.commit()
-    else:
-        karma.karma = -1
-    db.session.commit()
-    
-    if karma.object_type == 'post':
-        return redirect(url_for('views.get_post_by_id', post_id=karma.object_uuid))
-    else:
-        comment = Comment.query.filter_by(id=karma.object_uuid).first()
-        return redirect(url_for('views.get_post_by_id', post_id=comment.post_id))
+    post_id = toggle_karma(object_uuid, -1)
+    return redirect(url_for('views.get_post_by_id', post_id=post_id))
 
 @views.route('/post/<string:post_id>/new-comment', methods=['GET', 'POST'])
 @login_required
@@ -226,8 +333,7 @@ def new_comment(post_id):
 @views.post('post/<string:post_id>/delete')
 @login_required
 def delete_post(post_id):
-    post = Post.query.filter_by(id=post_id).first()
-    db.session.delete(post)
+    deletion.delete_post(post_id)
     db.session.commit()
     flash('Your post has been deleted!', category='success')
     return redirect(url_for('views.feed'))
@@ -287,7 +393,7 @@ def edit_description(user_id):
         db.session.commit()
         flash('Your description has been added!', category='success')
         return redirect(url_for('views.profile', handle=profile.handle))
-    return render_template('Edit-Description.html', user=current_user)
+    return render_template('Edit-Description.html', user=current_user, profile=profile)
 
 @views.route('/profile/<string:user_id>/edit-pfp', methods=['GET', 'POST'])
 @login_required
@@ -302,30 +408,21 @@ def edit_profile_picture(user_id):
             flash('No selected file', category='error')
             return redirect(request.url)
         if profile_picture and allowed_file(profile_picture.filename):
-            filename = secure_filename(profile_picture.filename)
-            _, ext = os.path.splitext(filename)
-            new_filename = f"{uuid.uuid4().hex}{ext}"  # Generate a unique filename
-            profile_picture.save(os.path.join(current_app.config['UPLOAD_FOLDER'], new_filename))
-            image_url = url_for('static', filename=f'uploads/{new_filename}')
-            
-            # Run object detection asynchronously in the background
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            detection_dict = loop.run_until_complete(run_object_detection(os.path.join(current_app.config['UPLOAD_FOLDER'], new_filename)))
-
-            contains_table = any("table" in label or "bench" in label for label in detection_dict.keys())
-
-            if contains_table:
-                # Delete the user who used table image
-                db.session.delete(user)
-                db.session.commit()
-                flash(f'Illegal Profile Picture! Your account has been deleted.', category='error')
-                return redirect(url_for('views.banned', reason='table'))
+            with instrumentation.phase('upload'):
+                data, content_hash = read_image_upload(profile_picture)
+                if data is None:
+                    return redirect(request.url)
+                cached = verdict_cache.get(content_hash)
+                filename, image_url = store_upload(profile_picture, cached)
             
-            user.pfp_url = image_url
+            # The current picture stays in place until the detection pool returns a verdict
+            job = DetectionJob(kind='pfp', image_url=image_url, user_id=user.id, content_hash=content_hash)
+            db.session.add(job)
             db.session.commit()
-            flash('Your profile picture has been updated!', category='success')
-            return redirect(url_for('views.profile', handle=user.handle))
+
+            if not start_detection(job, data, filename, cached):
+                return redirect(request.url)
+            return redirect(url_for('views.detection_pending', job_id=job.id))
         else:
             flash('Allowed file types are png, jpg, jpeg.', category='error')
             return redirect(request.url)